@@ -0,0 +1,143 @@
+import time
+
+import flask
+import numpy as np
+from PIL import Image
+
+from matching import (
+    PREFILTER_KEEP,
+    SCORERS,
+    extract_colours,
+    extract_descriptors,
+    extract_hashes,
+    get_hash_store,
+    rank_descriptors,
+    rank_hashes,
+    rank_hashes_batch,
+)
+from util import frame_number
+
+api = flask.Blueprint("api", __name__, url_prefix="/api")
+
+
+def format_matches(matches):
+    frame_names = get_hash_store().frame_names
+    return [
+        {
+            "frame": frame_number(frame_names[match.frame]),
+            "score": match.score,
+            "inliers": match.inliers,
+            "confidence": match.confidence,
+        }
+        for match in matches
+    ]
+
+
+@api.route("/match", methods=["POST"])
+def match_upload():
+    # Accept either a multipart "image" field or the raw image as the request body
+    if "image" in flask.request.files:
+        data = flask.request.files["image"].read()
+    else:
+        data = flask.request.get_data()
+
+    if not data:
+        return flask.jsonify(error="No image provided"), 400
+
+    scorer = flask.request.args.get("scorer", "hashes")
+    if scorer not in SCORERS:
+        return flask.jsonify(error=f"Unknown scorer {scorer!r}"), 400
+
+    start = time.perf_counter()
+    try:
+        if scorer == "descriptors":
+            features = extract_descriptors(data)
+        else:
+            features, points = extract_hashes(data)
+            # Only read when the colour prefilter is on
+            colours = extract_colours(data) if PREFILTER_KEEP else None
+    except Image.DecompressionBombError:
+        return flask.jsonify(error="Image is too large"), 413
+    except (OSError, ValueError):
+        return flask.jsonify(error="Could not decode image"), 400
+    extract_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if scorer == "descriptors":
+        matches = rank_descriptors(features)
+    else:
+        matches = rank_hashes(features, points, colours)
+    match_time = time.perf_counter() - start
+
+    return flask.jsonify(
+        matches=format_matches(matches),
+        scorer=scorer,
+        **{f"n_{scorer}": len(features)},
+        extract_ms=round(1000 * extract_time, 2),
+        match_ms=round(1000 * match_time, 2),
+    )
+
+
+def batch_hash_lists(request):
+    # Hints are given as uploaded "images", or as JSON stored "names" or raw "hashes",
+    # the last without points so those matches go unverified
+    if request.files:
+        queries = [
+            extract_hashes(file.read()) for file in request.files.getlist("images")
+        ]
+        return [hashes for hashes, _ in queries], [points for _, points in queries]
+
+    body = request.get_json(silent=True) or {}
+    if not isinstance(body, dict):
+        raise ValueError("body is not an object")
+
+    if "names" in body:
+        if not isinstance(body["names"], list) or not all(
+            isinstance(name, str) for name in body["names"]
+        ):
+            raise ValueError("names is not a list of image names")
+
+        hash_store = get_hash_store()
+        return (
+            [hash_store[name] for name in body["names"]],
+            [hash_store.hash_points(name) for name in body["names"]],
+        )
+
+    if not isinstance(body.get("hashes", []), list) or not all(
+        isinstance(hashes, list) for hashes in body.get("hashes", [])
+    ):
+        raise ValueError("hashes is not a list of hash lists")
+
+    hash_lists = [
+        np.array(hashes, dtype=np.uint64) for hashes in body.get("hashes", [])
+    ]
+    return hash_lists, None
+
+
+@api.route("/match/batch", methods=["POST"])
+def match_batch():
+    start = time.perf_counter()
+    try:
+        hash_lists, point_lists = batch_hash_lists(flask.request)
+    except KeyError as e:
+        return flask.jsonify(error=f"Unknown image {e}"), 400
+    except Image.DecompressionBombError:
+        return flask.jsonify(error="Image is too large"), 413
+    except (OSError, ValueError, OverflowError, TypeError) as e:
+        return flask.jsonify(error=f"Could not read hints: {e}"), 400
+    extract_time = time.perf_counter() - start
+
+    if not hash_lists:
+        return flask.jsonify(error="No hints provided"), 400
+
+    start = time.perf_counter()
+    matches = rank_hashes_batch(hash_lists, point_lists)
+    match_time = time.perf_counter() - start
+
+    return flask.jsonify(
+        results=[format_matches(m) for m in matches],
+        n_queries=len(hash_lists),
+        extract_ms=round(1000 * extract_time, 2),
+        match_ms=round(1000 * match_time, 2),
+        queries_per_second=round(len(hash_lists) / (extract_time + match_time), 1),
+    )
@@ -1,11 +1,170 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import time
+
 import dash
 import dash_bootstrap_components as dbc
 import flask
 from dash import Dash, Input, Output, dcc, html
 
+from api import api
+from matching import cache_stats, index_stats
+from metrics import observe, render
+
 app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], use_pages=True)
 server = app.server
+server.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024
+server.register_blueprint(api)
 app.layout = dash.page_container
 
+# Generated images and keypoints are named after a digest of their content
+FINGERPRINTED_ASSET = re.compile(r"^/assets/(imgs|kps)/[^/]+\.[0-9a-f]{16}\.\w+$")
+
+# Requests with ?profile=1 get a cProfile report in place of their response, but
+# only from a server started with PROFILE_REQUESTS=1
+PROFILE_REQUESTS = os.environ.get("PROFILE_REQUESTS") == "1"
+PROFILE_LINES = 40
+
+
+@server.route("/stats/cache")
+def result_cache_stats():
+    return flask.jsonify(cache_stats())
+
+
+@server.route("/metrics")
+def prometheus_metrics():
+    # Kept per worker process, like the result cache they report on
+    cache = cache_stats()
+    index = index_stats()
+    return flask.Response(
+        render(
+            [
+                (
+                    "frame_game_result_cache_hits_total",
+                    "counter",
+                    "Rankings served from the result cache",
+                    cache["hits"],
+                ),
+                (
+                    "frame_game_result_cache_misses_total",
+                    "counter",
+                    "Rankings computed and added to the result cache",
+                    cache["misses"],
+                ),
+                (
+                    "frame_game_result_cache_size",
+                    "gauge",
+                    "Rankings held in the result cache",
+                    cache["currsize"],
+                ),
+                (
+                    "frame_game_index_frames",
+                    "gauge",
+                    "Frames in the hash index",
+                    index["frames"],
+                ),
+                (
+                    "frame_game_index_images",
+                    "gauge",
+                    "Frames and hints in the hash store",
+                    index["images"],
+                ),
+                (
+                    "frame_game_index_keys",
+                    "gauge",
+                    "Distinct hashes in the frame index",
+                    index["index_keys"],
+                ),
+                (
+                    "frame_game_index_postings",
+                    "gauge",
+                    "Hash and frame pairs in the frame index",
+                    index["index_postings"],
+                ),
+                (
+                    "frame_game_index_bytes",
+                    "gauge",
+                    "Size of the frame index arrays",
+                    index["index_bytes"],
+                ),
+                (
+                    "frame_game_hash_store_bytes",
+                    "gauge",
+                    "Size of the per image hashes and their points",
+                    index["hash_bytes"],
+                ),
+                (
+                    "frame_game_index_shards",
+                    "gauge",
+                    "Partitions the frame index is scored in",
+                    index["shards"],
+                ),
+            ]
+        ),
+        mimetype="text/plain; version=0.0.4",
+    )
+
+
+def request_handler():
+    # Dash callbacks share one route, so they are told apart by their outputs
+    if flask.request.path == "/_dash-update-component":
+        body = flask.request.get_json(silent=True) or {}
+        callback = app.callback_map.get(body.get("output"), {}).get("callback")
+        return getattr(callback, "__name__", "unknown")
+
+    return flask.request.url_rule.rule if flask.request.url_rule else "unmatched"
+
+
+@server.before_request
+def start_request_timer():
+    flask.g.request_start = time.perf_counter()
+
+
+# Registered first so that it runs last of the after request hooks
+@server.after_request
+def observe_request_time(response):
+    observe(
+        "frame_game_request_seconds",
+        time.perf_counter() - flask.g.request_start,
+        handler=request_handler(),
+    )
+    return response
+
+
+@server.after_request
+def cache_fingerprinted_assets(response):
+    # A fingerprinted URL never changes content, so browsers and CDNs can keep it
+    if FINGERPRINTED_ASSET.match(flask.request.path):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+
+    return response
+
+
+if PROFILE_REQUESTS:
+
+    @server.before_request
+    def start_profile():
+        if flask.request.args.get("profile") == "1":
+            flask.g.profile = cProfile.Profile()
+            flask.g.profile.enable()
+
+    @server.after_request
+    def profile_report(response):
+        if "profile" not in flask.g:
+            return response
+
+        flask.g.profile.disable()
+        report = io.StringIO()
+        stats = pstats.Stats(flask.g.profile, stream=report)
+        stats.sort_stats("cumulative").print_stats(PROFILE_LINES)
+        return flask.Response(report.getvalue(), mimetype="text/plain")
+
+
 if __name__ == "__main__":
     app.run_server(debug=True)
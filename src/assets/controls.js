@@ -0,0 +1,19 @@
+// Control callbacks that only reshape state already in the browser, so they
+// run clientside rather than costing a round trip to the server.
+(function () {
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        controls: {
+            url_state: function (...values) {
+                const inputs = window.dash_clientside.callback_context.inputs_list;
+                const params = new URLSearchParams();
+                inputs.forEach((input, i) => params.append(input.id, values[i]));
+                return `?${params}`;
+            },
+
+            hint_slider: function (frame, hintCounts) {
+                const nHints = (hintCounts && hintCounts[frame]) || 0;
+                return [nHints <= 1, nHints, 1];
+            },
+        },
+    });
+})();
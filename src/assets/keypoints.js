@@ -0,0 +1,93 @@
+// Draws SIFT keypoints over the frame and hint images, in the style of
+// cv.drawKeypoints with DRAW_RICH_KEYPOINTS, from the sidecars written by
+// generate_data.py: little-endian uint16 x, y (px), size (1/10 px) and
+// angle (1/100 degree) per keypoint, in the source image's pixels.
+(function () {
+    const OVERLAY_STYLE = {
+        position: "absolute",
+        top: 0,
+        left: 0,
+        pointerEvents: "none",
+    };
+    const COLORS = ["#ff3b30", "#34c759", "#007aff", "#ffcc00", "#af52de", "#5ac8fa"];
+
+    const sidecars = {};
+    let shown = {};
+
+    function loadKeypoints(url) {
+        if (!(url in sidecars)) {
+            sidecars[url] = fetch(url)
+                .then((response) => response.arrayBuffer())
+                .then((buffer) => new DataView(buffer));
+        }
+        return sidecars[url];
+    }
+
+    function drawKeypoints(canvas, img, keypoints, sidecar) {
+        const scale = img.clientWidth / sidecar.width;
+        canvas.width = img.clientWidth;
+        canvas.height = img.clientHeight;
+
+        const context = canvas.getContext("2d");
+        context.lineWidth = 1;
+
+        for (let i = 0; i < keypoints.byteLength / 8; i++) {
+            const x = keypoints.getUint16(8 * i, true) * scale;
+            const y = keypoints.getUint16(8 * i + 2, true) * scale;
+            const radius = (keypoints.getUint16(8 * i + 4, true) / 20) * scale;
+            const angle = ((keypoints.getUint16(8 * i + 6, true) / 100) * Math.PI) / 180;
+
+            context.strokeStyle = COLORS[i % COLORS.length];
+            context.beginPath();
+            context.arc(x, y, radius, 0, 2 * Math.PI);
+            context.moveTo(x, y);
+            context.lineTo(x + radius * Math.cos(angle), y + radius * Math.sin(angle));
+            context.stroke();
+        }
+    }
+
+    function render(id, sidecar) {
+        const canvas = document.getElementById(`${id}_overlay`);
+        const img = document.querySelector(`#${id}_link img`);
+        if (!canvas || !img) {
+            return;
+        }
+
+        const draw = () =>
+            loadKeypoints(sidecar.url).then((keypoints) => {
+                // Skip stale draws if the image changed while the sidecar loaded
+                if (shown[id] === sidecar) {
+                    drawKeypoints(canvas, img, keypoints, sidecar);
+                }
+            });
+
+        if (img.complete && img.naturalWidth) {
+            draw();
+        } else {
+            img.addEventListener("load", draw, {once: true});
+        }
+    }
+
+    window.addEventListener("resize", () => {
+        Object.entries(shown).forEach(([id, sidecar]) => render(id, sidecar));
+    });
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        keypoints: {
+            draw: function (show, data) {
+                shown = {};
+
+                return ["test_image", "source_image"].map((id) => {
+                    if (!show || !data || !data[id]) {
+                        return {display: "none"};
+                    }
+
+                    shown[id] = data[id];
+                    // Let the new images reach the DOM before drawing over them
+                    setTimeout(() => render(id, data[id]), 0);
+                    return OVERLAY_STYLE;
+                });
+            },
+        },
+    });
+})();
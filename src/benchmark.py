@@ -0,0 +1,533 @@
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime, timezone
+
+import cv2 as cv
+import numpy as np
+from PIL import Image
+
+from generate_data import encode_variants, keypoint_bytes
+from hash_index import (
+    build_inverted_index,
+    score_frames,
+    top_frames,
+    write_index_shards,
+)
+from hashing import MAX_IMG_HEIGHT, MAX_IMG_WIDTH, get_hashes, load_gray
+from matching import (
+    N_CANDIDATES,
+    N_MATCHES,
+    get_descriptor_store,
+    get_hash_store,
+    rank_descriptors,
+    rank_hashes,
+    top_matches,
+    verify_matches,
+)
+from prefilter import colour_signature, prefilter_frames
+from shard_pool import ShardPool
+from util import frame_number, glob_re, original_image_path, sort_images
+
+# The stores as built, which nothing here rebuilds
+hash_store = get_hash_store()
+descriptor_store = get_descriptor_store()
+
+
+class StageTimer:
+    def __init__(self):
+        self.timings = {}
+
+    def __call__(self, stage):
+        self.stage = stage
+        return self
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timings[self.stage] = time.perf_counter() - self.start
+
+
+def bench_build(image_filenames):
+    # Time each generate_data.py stage per image, without touching the assets
+    sift = cv.SIFT_create()
+    results = []
+
+    for image_filename in image_filenames:
+        timer = StageTimer()
+
+        path = f"{original_image_path}/{image_filename}"
+        with timer("decode"):
+            gray, _ = load_gray(path)
+
+        # The web variants and colour signature, as process_image makes them from
+        # the thumbnail, short of writing the variants out
+        with Image.open(path) as im:
+            size = im.size
+            with timer("encode"):
+                im.thumbnail((MAX_IMG_WIDTH, MAX_IMG_HEIGHT))
+                encode_variants(im)
+
+            with timer("colours"):
+                colour_signature(im)
+
+        with timer("detect"):
+            kps, _ = sift.detectAndCompute(gray, None)
+
+        with timer("get_hashes"):
+            get_hashes(kps)
+
+        with timer("export_keypoints"):
+            keypoint_bytes(kps)
+
+        results.append(
+            {
+                "image": image_filename,
+                "width": size[0],
+                "height": size[1],
+                "keypoints": len(kps),
+                "seconds": timer.timings,
+            }
+        )
+
+    return results
+
+
+def latency_stats(latencies):
+    latencies = np.array(latencies)
+    return {
+        "mean": 1000 * latencies.mean(),
+        "p50": 1000 * np.percentile(latencies, 50),
+        "p99": 1000 * np.percentile(latencies, 99),
+    }
+
+
+def synthetic_index(scale, frame_hashes, rng):
+    # The real frames plus synthetic ones sampled from the real postings, so
+    # hash frequencies keep their skew as the corpus grows, indexed with the same
+    # stop hash cutoff as the store
+    real = {name: np.array(hash_store[name]) for name in hash_store.frame_names}
+    postings = np.concatenate(list(real.values()))
+
+    hash_dict = dict(real)
+    for i in range(len(real) * (scale - 1)):
+        hash_dict[f"synthetic{i}"] = np.unique(rng.choice(postings, frame_hashes))
+
+    frame_names = list(hash_dict)
+    return (
+        build_inverted_index(hash_dict, frame_names, hash_store.max_df),
+        len(frame_names),
+    )
+
+
+def bench_query(scales, frame_hashes, seed=0):
+    hint_names = [name for name in hash_store.names if "-full" not in name]
+    queries = [np.array(hash_store[name]) for name in hint_names]
+    rng = np.random.default_rng(seed)
+    results = []
+
+    for scale in scales:
+        start = time.perf_counter()
+        index, n_frames = synthetic_index(scale, frame_hashes, rng)
+        index_time = time.perf_counter() - start
+
+        latencies = []
+        for hashes in queries:
+            start = time.perf_counter()
+            top_matches(score_frames(index, hashes, n_frames))
+            latencies.append(time.perf_counter() - start)
+
+        results.append(
+            {
+                "scale": scale,
+                "frames": n_frames,
+                "postings": len(index.frame_ids),
+                "index_bytes": sum(array.nbytes for array in index),
+                "index_seconds": index_time,
+                "queries": len(queries),
+                "latency_ms": latency_stats(latencies),
+                "queries_per_second": len(queries) / sum(latencies),
+            }
+        )
+        print(
+            f"{scale}x: {n_frames} frames, "
+            f"p50 {results[-1]['latency_ms']['p50']:.2f}ms, "
+            f"{results[-1]['queries_per_second']:.0f} queries/s"
+        )
+
+    return results
+
+
+def bench_shards(shard_counts, scale, frame_hashes, seed=0):
+    # Scoring a synthetic corpus shard by shard in a process pool, against the
+    # whole index in process, which it must match exactly
+    hint_names = [name for name in hash_store.names if "-full" not in name]
+    queries = [np.array(hash_store[name]) for name in hint_names]
+    index, n_frames = synthetic_index(scale, frame_hashes, np.random.default_rng(seed))
+
+    expected, latencies = [], []
+    for hashes in queries:
+        start = time.perf_counter()
+        expected.append(top_frames(score_frames(index, hashes, n_frames), N_CANDIDATES))
+        latencies.append(time.perf_counter() - start)
+
+    results = {
+        "scale": scale,
+        "frames": n_frames,
+        "queries": len(queries),
+        "single_latency_ms": latency_stats(latencies),
+        "shards": {},
+    }
+    print(f"1 shard: p50 {results['single_latency_ms']['p50']:.2f}ms")
+
+    with tempfile.TemporaryDirectory() as path:
+        for n_shards in shard_counts:
+            write_index_shards(path, index, n_frames, n_shards)
+            shard_pool = ShardPool(path, n_shards)
+            # Start the pool processes and open the shards before timing
+            shard_pool.top_frames(queries[0], N_CANDIDATES)
+
+            latencies, exact = [], 0
+            for hashes, (frames, scores) in zip(queries, expected):
+                start = time.perf_counter()
+                shard_frames, shard_scores = shard_pool.top_frames(hashes, N_CANDIDATES)
+                latencies.append(time.perf_counter() - start)
+                exact += np.array_equal(frames, shard_frames) and np.array_equal(
+                    scores, shard_scores
+                )
+            shard_pool.close()
+
+            results["shards"][n_shards] = {
+                "exact": exact,
+                "latency_ms": latency_stats(latencies),
+            }
+            print(
+                f"{n_shards} shards: {exact}/{len(queries)} exact, "
+                f"p50 {results['shards'][n_shards]['latency_ms']['p50']:.2f}ms"
+            )
+
+    return results
+
+
+def bench_prefilter(keeps):
+    # How often the colour prefilter keeps what full scoring ranks highest, and
+    # top-1 accuracy and latency when only the surviving frames are scored
+    frames = {frame_number(name) for name in hash_store.frame_names}
+    hint_names = [
+        name
+        for name in hash_store.names
+        if "-full" not in name and frame_number(name) in frames
+    ]
+    queries = [
+        (
+            name,
+            np.array(hash_store[name]),
+            np.array(hash_store.hash_points(name)),
+            hash_store.image_colours(name),
+        )
+        for name in hint_names
+    ]
+
+    def is_correct(matches, name):
+        best = hash_store.frame_names[matches[0].frame] if matches else None
+        return best is not None and frame_number(best) == frame_number(name)
+
+    results = {}
+    for keep in [None] + keeps:
+        latencies, top1_recall, top10_recall = [], [], []
+        correct, verified_correct = 0, 0
+        for name, hashes, points, colours in queries:
+            full = top_matches(hash_store.score(hashes), N_MATCHES)
+
+            start = time.perf_counter()
+            frame_mask = (
+                None
+                if keep is None
+                else prefilter_frames(colours, hash_store.frame_colours, keep)
+            )
+            scores = hash_store.score(hashes, frame_mask)
+            matches = top_matches(scores, N_MATCHES)
+            latencies.append(time.perf_counter() - start)
+
+            if full and frame_mask is not None:
+                top1_recall.append(frame_mask[full[0].frame])
+                top10_recall.append(np.mean([frame_mask[m.frame] for m in full]))
+
+            correct += is_correct(matches, name)
+            verified_correct += is_correct(
+                verify_matches(top_matches(scores, N_CANDIDATES), hashes, points), name
+            )
+
+        label = "all frames" if keep is None else f"keep {keep}"
+        results[label] = {
+            "keep": keep,
+            "queries": len(queries),
+            "top1_recall": float(np.mean(top1_recall)) if top1_recall else 1.0,
+            "top10_recall": float(np.mean(top10_recall)) if top10_recall else 1.0,
+            "top1": correct,
+            "verified_top1": verified_correct,
+            "latency_ms": latency_stats(latencies),
+        }
+        print(
+            f"{label}: recall of full top-1 {results[label]['top1_recall']:.2f}, "
+            f"top-10 {results[label]['top10_recall']:.2f}, "
+            f"top-1 {correct}/{len(queries)} "
+            f"(verified {verified_correct}/{len(queries)}), "
+            f"p50 {results[label]['latency_ms']['p50']:.2f}ms"
+        )
+
+    return results
+
+
+def bench_scorers():
+    # Top-1 accuracy of each scorer on the bundled hints whose frame is indexed
+    frames = {frame_number(name) for name in hash_store.frame_names}
+    hint_names = [
+        name
+        for name in hash_store.names
+        if "-full" not in name and frame_number(name) in frames
+    ]
+
+    start = time.perf_counter()
+    descriptor_store.flann
+    flann_time = time.perf_counter() - start
+
+    hash_bytes = sum(array.nbytes for array in hash_store.index)
+
+    # Query arguments of each scorer's rank function for a stored image
+    scorers = {
+        "hashes": (
+            lambda name: (np.array(hash_store[name]),),
+            rank_hashes,
+            hash_bytes,
+            0,
+        ),
+        "verified hashes": (
+            lambda name: (
+                np.array(hash_store[name]),
+                np.array(hash_store.hash_points(name)),
+            ),
+            rank_hashes,
+            hash_bytes + hash_store.points.nbytes,
+            0,
+        ),
+        "descriptors": (
+            lambda name: (np.array(descriptor_store[name]),),
+            rank_descriptors,
+            descriptor_store.nbytes(),
+            flann_time,
+        ),
+    }
+
+    results = {}
+    for scorer, (query, rank, index_bytes, index_time) in scorers.items():
+        latencies = []
+        correct = 0
+        for name in hint_names:
+            features = query(name)
+            start = time.perf_counter()
+            matches = rank(*features)
+            latencies.append(time.perf_counter() - start)
+
+            if matches:
+                best = hash_store.frame_names[matches[0].frame]
+                correct += frame_number(best) == frame_number(name)
+
+        results[scorer] = {
+            "queries": len(hint_names),
+            "top1": correct,
+            "top1_accuracy": correct / len(hint_names),
+            "index_bytes": index_bytes,
+            "index_seconds": index_time,
+            "latency_ms": latency_stats(latencies),
+        }
+        print(
+            f"{scorer}: top-1 {correct}/{len(hint_names)}, "
+            f"p50 {results[scorer]['latency_ms']['p50']:.2f}ms, "
+            f"index {index_bytes / 1e6:.1f}MB"
+        )
+
+    return results
+
+
+def parse_importtime(stderr, module="app"):
+    # Cumulative seconds of each module the given module imports directly; a
+    # module's imports are listed before it, one level deeper
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            imports[name.strip()] = int(cumulative) / 1e6
+        elif depth == 0:
+            if name.strip() == module:
+                return int(cumulative) / 1e6, imports
+            imports = {}
+
+    raise ValueError(f"{module} was not imported")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_to_first_response(timeout=60):
+    # From launching gunicorn, as the container does, to the first page served
+    port = free_port()
+    env = {**os.environ, "GUNICORN_BIND": f"127.0.0.1:{port}", "GUNICORN_WORKERS": "1"}
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "app:server"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/") as response:
+                    response.read()
+                return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.01)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def bench_startup(runs):
+    import_times, modules, response_times = [], [], []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import app"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        import_time, imports = parse_importtime(result.stderr)
+        import_times.append(import_time)
+        modules.append(imports)
+        response_times.append(time_to_first_response())
+
+    # Median cumulative import time of the app's direct imports, slowest first
+    breakdown = {
+        name: float(np.median([run.get(name, 0) for run in modules]))
+        for name in modules[0]
+    }
+    results = {
+        "runs": runs,
+        "import_seconds": float(np.median(import_times)),
+        "first_response_seconds": float(np.median(response_times)),
+        "imports": dict(sorted(breakdown.items(), key=lambda item: -item[1])),
+    }
+    print(
+        f"import app: {results['import_seconds']:.2f}s, "
+        f"first response: {results['first_response_seconds']:.2f}s"
+    )
+    for name, seconds in list(results["imports"].items())[:5]:
+        print(f"  {name}: {seconds:.2f}s")
+
+    return results
+
+
+def summarize_build(results):
+    stages = results[0]["seconds"].keys() if results else []
+    return {
+        stage: {
+            "total": sum(r["seconds"][stage] for r in results),
+            "mean": float(np.mean([r["seconds"][stage] for r in results])),
+            "max": max(r["seconds"][stage] for r in results),
+        }
+        for stage in stages
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time the data build stages and the frame match query path"
+    )
+    parser.add_argument("--out", default="benchmark.json")
+    parser.add_argument("--images", type=int, help="only time the first N images")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument(
+        "--frame-hashes",
+        type=int,
+        default=250,
+        help="hashes per synthetic frame, bounds memory at large scales",
+    )
+    parser.add_argument("--skip-build", action="store_true")
+    parser.add_argument("--skip-query", action="store_true")
+    parser.add_argument("--skip-scorers", action="store_true")
+    parser.add_argument("--skip-shards", action="store_true")
+    parser.add_argument("--skip-prefilter", action="store_true")
+    parser.add_argument(
+        "--prefilter-keeps",
+        type=float,
+        nargs="+",
+        default=[0.75, 0.5, 0.25, 0.1],
+        help="fractions of frames the colour prefilter keeps",
+    )
+    parser.add_argument("--shards", type=int, nargs="+", default=[2, 4])
+    parser.add_argument(
+        "--shard-scale", type=int, default=100, help="corpus scale to shard"
+    )
+    parser.add_argument("--skip-startup", action="store_true")
+    parser.add_argument(
+        "--startup-runs", type=int, default=3, help="cold starts to take the median of"
+    )
+    args = parser.parse_args()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "opencv": cv.__version__,
+            "store_version": hash_store.version,
+            "descriptor_store_version": descriptor_store.version,
+        }
+    }
+
+    if not args.skip_build:
+        image_filenames = sort_images(
+            glob_re("frame.*", os.listdir(original_image_path))
+        )
+        build = bench_build(image_filenames[: args.images])
+        report["build"] = {"images": build, "stages": summarize_build(build)}
+        for stage, stats in report["build"]["stages"].items():
+            print(f"{stage}: {stats['total']:.2f}s total, {stats['max']:.3f}s max")
+
+    if not args.skip_query:
+        report["query"] = bench_query(args.scales, args.frame_hashes)
+
+    if not args.skip_scorers:
+        report["scorers"] = bench_scorers()
+
+    if not args.skip_prefilter:
+        report["prefilter"] = bench_prefilter(args.prefilter_keeps)
+
+    if not args.skip_shards:
+        report["shards"] = bench_shards(
+            args.shards, args.shard_scale, args.frame_hashes
+        )
+
+    if not args.skip_startup:
+        report["startup"] = bench_startup(args.startup_runs)
+
+    with open(args.out, "w") as file:
+        json.dump(report, file, indent=2)
@@ -0,0 +1,67 @@
+import json
+import os
+
+from util import (
+    asset_manifest_path,
+    catalog_path,
+    frame_number,
+    kps_route,
+    src_image_route,
+)
+
+_loaded = {}
+
+
+def build_catalog(image_names):
+    # Frame number -> hint count plus the full image and keypoint routes
+    catalog = {}
+    for image_name in image_names:
+        name = image_name.split(".")[0]
+        entry = catalog.setdefault(
+            frame_number(image_name), {"hints": 0, "full": None, "kps": None}
+        )
+
+        if name.endswith("-full"):
+            entry["full"] = f"{src_image_route}{name}.jpg"
+            entry["kps"] = f"{kps_route}{name}.bin"
+        else:
+            entry["hints"] += 1
+
+    return dict(sorted(catalog.items()))
+
+
+def write_json(path, data):
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(data, file, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def write_catalog(catalog):
+    write_json(catalog_path, catalog)
+
+
+def load_json(path, parse=lambda data: data):
+    # Reload only when generate_data.py has written a new version of the file
+    mtime = os.stat(path).st_mtime_ns
+    if path not in _loaded or _loaded[path][0] != mtime:
+        with open(path) as file:
+            _loaded[path] = mtime, parse(json.load(file))
+
+    return _loaded[path][1]
+
+
+def get_catalog():
+    return load_json(
+        catalog_path,
+        lambda catalog: {int(frame_no): entry for frame_no, entry in catalog.items()},
+    )
+
+
+def asset_entry(route):
+    # Fingerprinted URL and responsive variants of a generated image, if any
+    return load_json(asset_manifest_path).get(route)
+
+
+def asset_url(route):
+    entry = asset_entry(route)
+    return entry["src"] if entry else route
@@ -0,0 +1,132 @@
+import hashlib
+import json
+
+import cv2 as cv
+import numpy as np
+
+from hash_index import save_arrays
+
+# Lowe's ratio test: keep a match only if it is clearly closer than the runner-up
+RATIO = 0.75
+FLANN_TREES = 4
+FLANN_CHECKS = 64
+
+
+def quantize_descriptors(descriptors):
+    # OpenCV's SIFT descriptors are already whole numbers in 0-255
+    if descriptors is None:
+        return np.zeros((0, 128), dtype=np.uint8)
+
+    return np.clip(np.round(descriptors), 0, 255).astype(np.uint8)
+
+
+class DescriptorStore:
+    # Per-image SIFT descriptors and a FLANN KD-forest over the frames' descriptors
+    def __init__(
+        self, names, frame_names, descriptors, offsets, frame_rows, frame_ids, version
+    ):
+        self.names = names
+        self.frame_names = frame_names
+        self.descriptors = descriptors
+        self.offsets = offsets
+        self.version = version
+
+        self._positions = {name: i for i, name in enumerate(names)}
+        self._frame_rows = frame_rows
+        self._frame_ids = frame_ids
+        self._flann = None
+
+    def __contains__(self, name):
+        return name in self._positions
+
+    def __getitem__(self, name):
+        i = self._positions[name]
+        return self.descriptors[self.offsets[i] : self.offsets[i + 1]]
+
+    def to_dict(self):
+        return {name: np.array(self[name]) for name in self.names}
+
+    @property
+    def flann(self):
+        # FLANN only indexes float32, so the KD-forest is built on first use
+        if self._flann is None:
+            self._flann = cv.flann_Index(
+                self.descriptors[self._frame_rows].astype(np.float32),
+                {"algorithm": 1, "trees": FLANN_TREES},
+            )
+
+        return self._flann
+
+    def nbytes(self):
+        # Descriptors as stored, plus the float32 copy held by the FLANN index
+        return self.descriptors.nbytes + 4 * self.descriptors[self._frame_rows].size
+
+    def score(self, descriptors):
+        n_frames = len(self.frame_names)
+        if len(descriptors) == 0 or len(self._frame_rows) < 2:
+            return np.zeros(n_frames, dtype=np.int64)
+
+        neighbours, distances = self.flann.knnSearch(
+            np.asarray(descriptors, dtype=np.float32),
+            2,
+            params={"checks": FLANN_CHECKS},
+        )
+
+        # Distances are squared L2
+        good = distances[:, 0] < RATIO**2 * distances[:, 1]
+        return np.bincount(self._frame_ids[neighbours[good, 0]], minlength=n_frames)
+
+
+def write_descriptor_store(path, descriptor_dict, frame_names):
+    names = sorted(descriptor_dict)
+    descriptors = [descriptor_dict[name] for name in names]
+    offsets = np.append(0, np.cumsum([len(d) for d in descriptors])).astype(np.int64)
+
+    positions = {name: i for i, name in enumerate(names)}
+    frame_rows = [
+        np.arange(offsets[positions[name]], offsets[positions[name] + 1])
+        for name in frame_names
+    ]
+
+    arrays = {
+        "descriptors": np.concatenate(descriptors)
+        if descriptors
+        else np.zeros((0, 128), dtype=np.uint8),
+        "offsets": offsets,
+        "frame_rows": np.concatenate(frame_rows).astype(np.int64)
+        if frame_rows
+        else np.array([], dtype=np.int64),
+        "frame_ids": np.repeat(
+            np.arange(len(frame_names)), [len(rows) for rows in frame_rows]
+        ).astype(np.int64),
+    }
+
+    version = hashlib.sha256(json.dumps([names, frame_names]).encode())
+    for array in arrays.values():
+        version.update(array.tobytes())
+
+    save_arrays(
+        path,
+        arrays,
+        {"version": version.hexdigest(), "names": names, "frame_names": frame_names},
+    )
+
+
+def open_descriptor_store(path):
+    with open(f"{path}/meta.json") as file:
+        meta = json.load(file)
+
+    arrays = {
+        field: np.load(f"{path}/{field}.npy", mmap_mode="r")
+        for field in ["descriptors", "offsets", "frame_rows", "frame_ids"]
+    }
+
+    return DescriptorStore(
+        meta["names"],
+        meta["frame_names"],
+        arrays["descriptors"],
+        arrays["offsets"],
+        arrays["frame_rows"],
+        arrays["frame_ids"],
+        meta["version"],
+    )
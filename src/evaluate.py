@@ -0,0 +1,145 @@
+import argparse
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import cv2 as cv
+import numpy as np
+from PIL import Image
+
+from generate_data import MAX_HASH_DF, patch_keypoint_pickling
+from hash_index import build_inverted_index, score_frames
+from hashing import HASH_PARAMS, get_hashes
+from matching import top_matches
+from util import frame_number, glob_re, original_image_path, sort_images
+
+# Hashing parameter overrides, query probe fields and index options to compare
+SETTINGS = {
+    "default": {},
+    "pixel units": {
+        "params": {
+            "scale_invariant": False,
+            "deg_quant_f": 1,
+            "size_quant_f": 1,
+            "dist_quant_f": 1,
+        }
+    },
+    "deg 1": {"params": {"deg_quant_f": 1}},
+    "deg 4": {"params": {"deg_quant_f": 4}},
+    "size 0.1": {"params": {"size_quant_f": 0.1}},
+    "dist 0.5": {"params": {"dist_quant_f": 0.5}},
+    "neighbors 8": {"params": {"n_neighbors": 8}},
+    "probe d12": {"probe_fields": ("d12",)},
+    "probe s2 d12": {"probe_fields": ("s2", "d12")},
+    "probe a12 d12": {"probe_fields": ("a12", "d12")},
+    "unweighted, all hashes": {"idf": False, "max_df": None},
+    "idf, all hashes": {"max_df": None},
+    "idf, max df 0.1": {"max_df": 0.1},
+    "idf, max df 0.05": {"max_df": 0.05},
+}
+
+
+def init_worker(scale):
+    global sift, hint_scale
+    sift = cv.SIFT_create()
+    hint_scale = scale
+
+
+def detect_keypoints(image_filename):
+    im = Image.open(f"{original_image_path}/{image_filename}")
+
+    # Hints can be rescaled to check how the hashes cope with a change of scale
+    if "-full" not in image_filename and hint_scale != 1:
+        im = im.resize(
+            (round(im.width * hint_scale), round(im.height * hint_scale)),
+            Image.Resampling.LANCZOS,
+        )
+
+    return image_filename, sift.detect(np.asarray(im.convert("L")), None)
+
+
+def evaluate(
+    frame_kps, hint_kps, params={}, probe_fields=(), max_df=MAX_HASH_DF, idf=True
+):
+    params = {**HASH_PARAMS, **params}
+    frame_names = list(frame_kps)
+    hash_dict = {name: get_hashes(kps, params) for name, kps in frame_kps.items()}
+    index = build_inverted_index(hash_dict, frame_names, max_df)
+    if not idf:
+        index = index._replace(weights=np.ones_like(index.weights))
+
+    frames = [frame_number(name) for name in frame_names]
+    correct = 0
+    hash_times, score_times = [], []
+    for name, kps in hint_kps.items():
+        start = time.perf_counter()
+        hashes = get_hashes(kps, params, probe_fields)
+        hash_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        matches = top_matches(score_frames(index, hashes, len(frame_names)))
+        score_times.append(time.perf_counter() - start)
+
+        if matches:
+            correct += frames[matches[0][0]] == frame_number(name)
+
+    return {
+        "params": params,
+        "probe_fields": list(probe_fields),
+        "max_df": max_df,
+        "idf": idf,
+        "queries": len(hint_kps),
+        "top1": correct,
+        "top1_accuracy": correct / len(hint_kps),
+        "index_keys": len(index.keys),
+        "index_bytes": sum(array.nbytes for array in index),
+        "hash_ms_p50": 1000 * np.percentile(hash_times, 50),
+        "score_ms_p50": 1000 * np.percentile(score_times, 50),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare hashing settings by top-1 accuracy on the bundled hints"
+    )
+    parser.add_argument("--out", default="evaluation.json")
+    parser.add_argument(
+        "--settings", nargs="+", choices=list(SETTINGS), default=list(SETTINGS)
+    )
+    parser.add_argument(
+        "--hint-scale", type=float, default=1, help="resize hints by this factor"
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    patch_keypoint_pickling()
+
+    image_filenames = sort_images(glob_re("frame.*", os.listdir(original_image_path)))
+    with Pool(
+        args.workers, initializer=init_worker, initargs=(args.hint_scale,)
+    ) as pool:
+        keypoints = dict(pool.imap_unordered(detect_keypoints, image_filenames))
+
+    frame_kps = {name: keypoints[name] for name in image_filenames if "-full" in name}
+    frames = {frame_number(name) for name in frame_kps}
+    # Only hints whose frame is indexed can be answered correctly
+    hint_kps = {
+        name: keypoints[name]
+        for name in image_filenames
+        if "-full" not in name and frame_number(name) in frames
+    }
+
+    results = {}
+    for setting in args.settings:
+        results[setting] = evaluate(frame_kps, hint_kps, **SETTINGS[setting])
+        print(
+            f"{setting}: top-1 {results[setting]['top1']}/{len(hint_kps)}, "
+            f"{results[setting]['index_keys']} keys "
+            f"({results[setting]['index_bytes'] / 1e6:.1f}MB), "
+            f"hash {results[setting]['hash_ms_p50']:.2f}ms, "
+            f"score {results[setting]['score_ms_p50']:.2f}ms"
+        )
+
+    with open(args.out, "w") as file:
+        json.dump({"hint_scale": args.hint_scale, "results": results}, file, indent=2)
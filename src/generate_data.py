@@ -1,21 +1,76 @@
+import argparse
 import copyreg
+import hashlib
+import io
+import json
 import os
-import pickle
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 
 import cv2 as cv
 import numpy as np
 from PIL import Image
 from tqdm import tqdm
-from sklearn.neighbors import NearestNeighbors
 
-from util import glob_re, original_image_path, sort_images
-
-N_NEIGHBORS = 5
-DEG_QUANT_F = 1
-DECIMALS = 0
-
-MAX_IMG_WIDTH = 1080
-MAX_IMG_HEIGHT = 1080
+from catalog import build_catalog, write_catalog, write_json
+from descriptor_index import (
+    open_descriptor_store,
+    quantize_descriptors,
+    write_descriptor_store,
+)
+from hash_index import HASH_FIELD_BITS, HASH_FIELDS, open_hash_store, write_hash_store
+from hashing import (
+    DEG_QUANT_F,
+    DIST_QUANT_F,
+    HASH_PARAMS,
+    MAX_IMG_HEIGHT,
+    MAX_IMG_WIDTH,
+    N_NEIGHBORS,
+    SCALE_INVARIANT,
+    SIZE_QUANT_F,
+    get_hashes,
+    load_gray,
+    scale_keypoints,
+)
+from prefilter import colour_signature
+from util import (
+    asset_manifest_path,
+    descriptor_store_path,
+    glob_re,
+    hash_store_path,
+    kps_route,
+    original_image_path,
+    sort_images,
+    src_image_route,
+)
+
+# Stop hashes, found in more than this fraction of the frames, are left out of
+# the index. See evaluate.py for the accuracy of other fractions
+MAX_HASH_DF = 0.1
+
+# Frame range partitions of the index, each scored in its own process by the app
+N_SHARDS = 1
+
+# Largest side (px) frames are detected at, larger ones are reduced first and
+# their keypoints mapped back to source pixels, bounding build memory; None
+# detects at the source resolution
+MAX_DETECT_SIZE = None
+
+# Narrower responsive variants, on top of the MAX_IMG_WIDTH thumbnail
+VARIANT_WIDTHS = (360, 720)
+
+VARIANT_FORMATS = {
+    "JPEG": {"quality": 50, "progressive": True, "optimize": True},
+    "WEBP": {"quality": 50, "method": 4},
+}
+VARIANT_EXTENSIONS = {"JPEG": "jpg", "WEBP": "webp", "AVIF": "avif"}
+
+# AVIF needs a Pillow build (or plugin) with an encoder for it
+Image.init()
+if "AVIF" in Image.SAVE:
+    VARIANT_FORMATS["AVIF"] = {"quality": 50}
+
+MANIFEST_PATH = "build_manifest.json"
 
 
 def patch_keypoint_pickling():
@@ -38,94 +93,406 @@ def patch_keypoint_pickling():
     copyreg.pickle(cv.KeyPoint().__class__, _pickle_keypoint)
 
 
-def angle(p1, p2):
-    if np.allclose(p1, p2):
-        return 0
+def peak_rss():
+    # High water mark of this process's resident memory, in bytes, on Linux
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
 
-    x1 = np.array([0, 1])
-    x2 = p2 - p1
-    dp = np.dot(x1, x2 / np.linalg.norm(x2))
-    return np.arccos(dp)
 
+def reset_peak_rss():
+    # Linux lets the high water mark be reset, so it can be read per image
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
 
-def get_hashes(kps):
-    neigh = NearestNeighbors(n_neighbors=1 + N_NEIGHBORS)
 
-    kp_array = np.array([kp.pt for kp in kps])
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
 
-    hashes = []
+    return digest.hexdigest()
 
-    try:
-        neigh.fit(kp_array)
-        _, knn_inds = neigh.kneighbors(kp_array)
 
-        for i in range(len(kps)):
+def build_params():
+    # Changing any of these invalidates every image in the manifest
+    return {
+        "HASH_PARAMS": HASH_PARAMS,
+        "MAX_IMG_WIDTH": MAX_IMG_WIDTH,
+        "MAX_IMG_HEIGHT": MAX_IMG_HEIGHT,
+        "MAX_DETECT_SIZE": MAX_DETECT_SIZE,
+        "VARIANT_WIDTHS": list(VARIANT_WIDTHS),
+        "VARIANT_FORMATS": VARIANT_FORMATS,
+    }
 
-            kp1 = kps[i]
-            kp1_pt = np.array(kp1.pt)
 
-            for j in range(0, 1 + N_NEIGHBORS):
+def asset_routes(image_filename):
+    name = image_filename.split(".")[0]
+    return f"{src_image_route}{name}.jpg", f"{kps_route}{name}.bin"
 
-                if i != knn_inds[i, j]:
 
-                    kp2 = kps[knn_inds[i, j]]
-                    kp2_pt = np.array(kp2.pt)
+def write_fingerprinted(data, route, suffix=""):
+    # Name the file after its content so it can be cached forever
+    digest = hashlib.sha256(data).hexdigest()[:16]
 
-                    a1 = kp1.angle / DEG_QUANT_F
-                    a2 = kp2.angle / DEG_QUANT_F
-                    a12 = np.rad2deg(angle(kp1_pt, kp2_pt)) / DEG_QUANT_F
-                    d12 = np.linalg.norm(kp1_pt - kp2_pt)
+    stem, extension = route.rsplit(".", 1)
+    fingerprinted_route = f"{stem}{suffix}.{digest}.{extension}"
+    with open(f".{fingerprinted_route}", "wb") as file:
+        file.write(data)
 
-                    pair_str = f"{a1:.{DECIMALS}f}|{a2:.{DECIMALS}f}|{kp1.size:.{DECIMALS}f}|{kp2.size:.{DECIMALS}f}|{a12:.{DECIMALS}f}|{d12:.{DECIMALS}f}"
+    return fingerprinted_route
 
-                    hashes.append(pair_str)
-    except:
-        pass
 
-    return hashes
+def encode_variant(im, format):
+    buffer = io.BytesIO()
+    im.save(buffer, format, **VARIANT_FORMATS[format])
+    return buffer.getvalue()
 
 
-patch_keypoint_pickling()
+def encode_variants(im):
+    # Resize and encode every width and format from the one decoded thumbnail,
+    # concurrently as Pillow releases the GIL while resampling and encoding.
+    # Images already under the thumbnail size are still undecoded, so decode them
+    # once before the threads share them. Returns (width, format, data) per variant
+    im.load()
+    widths = [width for width in VARIANT_WIDTHS if width < im.width]
 
-source_filenames = sort_images(glob_re(f"frame.*", os.listdir("./imgs")))
+    with ThreadPoolExecutor() as executor:
+        resized = [im] + list(
+            executor.map(
+                lambda width: im.resize(
+                    (width, round(im.height * width / im.width)),
+                    Image.Resampling.LANCZOS,
+                ),
+                widths,
+            )
+        )
+
+        jobs = [
+            (sized_im, format) for sized_im in resized for format in VARIANT_FORMATS
+        ]
+        return list(
+            executor.map(lambda job: (job[0].width, job[1], encode_variant(*job)), jobs)
+        )
 
-sift = cv.SIFT_create()
 
-hash_dict = {}
+def save_variants(im, route):
+    variants = []
+    for width, format, data in encode_variants(im):
+        suffix = "" if width == im.width else f"-{width}w"
+        variant_route = f"{route.rsplit('.', 1)[0]}.{VARIANT_EXTENSIONS[format]}"
+        variants.append(
+            {
+                "url": write_fingerprinted(data, variant_route, suffix),
+                "type": Image.MIME[format],
+                "width": width,
+                "bytes": len(data),
+            }
+        )
 
-# Force rebuild
-for image_filename in tqdm(source_filenames):
+    return {"src": variants[0]["url"], "variants": variants}
+
+
+def keypoint_bytes(kps):
+    # Little-endian uint16 x, y (px), size (1/10 px) and angle (1/100 degree)
+    # per keypoint, as read by assets/keypoints.js
+    data = np.array(
+        [(kp.pt[0], kp.pt[1], kp.size * 10, kp.angle * 100) for kp in kps]
+    ).reshape(-1, 4)
+    return np.clip(np.round(data), 0, 2**16 - 1).astype("<u2").tobytes()
+
+
+def save_keypoints(kps, size, route):
+    data = keypoint_bytes(kps)
+    fingerprinted_route = write_fingerprinted(data, route)
+
+    return {
+        "src": fingerprinted_route,
+        "width": size[0],
+        "height": size[1],
+        "variants": [
+            {
+                "url": fingerprinted_route,
+                "type": "application/octet-stream",
+                "bytes": len(data),
+            }
+        ],
+    }
+
+
+def asset_files(entry):
+    # Builds before responsive variants stored a single fingerprinted route
+    if entry is None:
+        return []
+    if isinstance(entry, str):
+        return [entry]
+
+    return [variant["url"] for variant in entry["variants"]]
+
+
+def report_variant_savings(asset_manifest):
+    # Bytes per variant, relative to serving every image as the full-size JPEG
+    totals = {}
+    for entry in asset_manifest.values():
+        if not entry["variants"][0]["type"].startswith("image/"):
+            continue
+
+        full_width = entry["variants"][0]["width"]
+        for variant in entry["variants"]:
+            size = "full" if variant["width"] == full_width else f"{variant['width']}w"
+            key = (variant["type"], size)
+            totals[key] = totals.get(key, 0) + variant["bytes"]
+
+    baseline = totals.get(("image/jpeg", "full"), 0)
+    for (type, size), total in sorted(totals.items()):
+        saving = 100 * (1 - total / baseline) if baseline else 0
+        print(
+            f"{type} {size}: {total / 1e6:.1f}MB ({saving:.0f}% smaller than full JPEG)"
+        )
 
-    name = image_filename.split(".")[0]
-    type = image_filename.split(".")[-1]
 
-    # Convert, scale down and transfer image
-    im = Image.open(f"{original_image_path}/{image_filename}")
-    source_img = cv.cvtColor(np.array(im), cv.COLOR_RGB2BGR)
+def load_manifest():
+    store_exists = os.path.exists(f"{hash_store_path}/meta.json") and os.path.exists(
+        f"{descriptor_store_path}/meta.json"
+    )
+    empty = {"params": build_params(), "images": {}}, {}, {}, {}, {}
+    if not os.path.exists(MANIFEST_PATH) or not store_exists:
+        return empty
+
+    with open(MANIFEST_PATH) as file:
+        manifest = json.load(file)
+
+    # Stores from before hash points or colour signatures were recorded are rebuilt
+    hash_store = open_hash_store(hash_store_path)
+    if (
+        manifest["params"] != build_params()
+        or hash_store.points is None
+        or hash_store.colours is None
+    ):
+        return empty
+
+    return (
+        manifest,
+        hash_store.to_dict(),
+        hash_store.points_dict(),
+        hash_store.colours_dict(),
+        open_descriptor_store(descriptor_store_path).to_dict(),
+    )
 
-    # Save small version for web
-    im.thumbnail((MAX_IMG_WIDTH, MAX_IMG_HEIGHT))
-    im.save(f"./assets/imgs/{name}.jpg", quality=50, progressive=True, optimize=True)
 
-    # Exract keypoints
-    gray = cv.cvtColor(source_img, cv.COLOR_BGR2GRAY)
-    kps = sift.detect(gray, None)
+def init_worker(params, max_detect_size):
+    # Each worker process keeps one SIFT instance for all of its images
+    global sift, hash_params, detect_size
+    sift = cv.SIFT_create()
+    hash_params = params
+    detect_size = (max_detect_size, max_detect_size) if max_detect_size else None
+
+
+def process_image(image_filename):
+    reset_peak_rss()
+    src_route, kps_route = asset_routes(image_filename)
+    path = f"{original_image_path}/{image_filename}"
+
+    # Save small version for web, which JPEGs decode straight to
+    with Image.open(path) as im:
+        size = im.size
+        im.thumbnail((MAX_IMG_WIDTH, MAX_IMG_HEIGHT))
+        assets = {src_route: save_variants(im, src_route)}
+        colours = colour_signature(im)
+
+    # Exract keypoints, in source pixels
+    gray, scale = load_gray(path, detect_size)
+    kps, descriptors = sift.detectAndCompute(gray, None)
+    kps = scale_keypoints(kps, scale)
+
+    hashes, points = get_hashes(kps, hash_params, return_points=True, clip=False)
+
+    # Keypoints are drawn over the image in the browser
+    assets[kps_route] = save_keypoints(kps, size, kps_route)
+
+    return (
+        image_filename,
+        hashes,
+        points,
+        colours,
+        quantize_descriptors(descriptors),
+        assets,
+        peak_rss(),
+    )
 
-    hash_dict[f"{name}.jpg"] = get_hashes(kps)
 
-    # Generate keypoint image
-    kp_img = cv.drawKeypoints(
-        source_img,
-        kps,
-        source_img,
-        flags=cv.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS,
+def remove_asset(asset_manifest, route, keep=()):
+    for fingerprinted_route in asset_files(asset_manifest.pop(route, None)):
+        path = f".{fingerprinted_route}"
+        if fingerprinted_route not in keep and os.path.exists(path):
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--force", action="store_true", help="rebuild every image")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--max-hash-df", type=float, default=MAX_HASH_DF)
+    parser.add_argument("--shards", type=int, default=N_SHARDS)
+    parser.add_argument(
+        "--max-detect-size",
+        type=int,
+        default=MAX_DETECT_SIZE,
+        help="largest side (px) to detect keypoints at",
     )
+    parser.add_argument("--n-neighbors", type=int, default=N_NEIGHBORS)
+    parser.add_argument("--deg-quant-f", type=float, default=DEG_QUANT_F)
+    parser.add_argument("--size-quant-f", type=float, default=SIZE_QUANT_F)
+    parser.add_argument("--dist-quant-f", type=float, default=DIST_QUANT_F)
+    parser.add_argument(
+        "--scale-invariant",
+        action=argparse.BooleanOptionalAction,
+        default=SCALE_INVARIANT,
+    )
+    args = parser.parse_args()
+
+    # Angles are bounded, so a step too fine for their bits fails here. Sizes and
+    # distances are not, and fail as the image with one too large is hashed
+    for flag in ("deg_quant_f", "size_quant_f", "dist_quant_f"):
+        if getattr(args, flag) <= 0:
+            parser.error(f"--{flag.replace('_', '-')} must be positive")
+    for field, degrees in (("a1", 360), ("a12", 180)):
+        bits = HASH_FIELD_BITS[HASH_FIELDS.index(field)]
+        if round(degrees / args.deg_quant_f) > 2**bits - 1:
+            parser.error(
+                f"--deg-quant-f {args.deg_quant_f} puts {field} past its {bits} bits"
+            )
+
+    HASH_PARAMS.update(
+        n_neighbors=args.n_neighbors,
+        deg_quant_f=args.deg_quant_f,
+        size_quant_f=args.size_quant_f,
+        dist_quant_f=args.dist_quant_f,
+        scale_invariant=args.scale_invariant,
+    )
+    MAX_DETECT_SIZE = args.max_detect_size
+
+    patch_keypoint_pickling()
+
+    source_filenames = sort_images(glob_re(f"frame.*", os.listdir("./imgs")))
+
+    if args.force:
+        manifest = {"params": build_params(), "images": {}}
+        hash_dict, point_dict, colour_dict, descriptor_dict = {}, {}, {}, {}
+    else:
+        manifest, hash_dict, point_dict, colour_dict, descriptor_dict = load_manifest()
+
+    asset_manifest = {}
+    if os.path.exists(asset_manifest_path):
+        with open(asset_manifest_path) as file:
+            asset_manifest = json.load(file)
+
+    # Forget images that have been removed from ./imgs
+    for image_filename in set(manifest["images"]) - set(source_filenames):
+        del manifest["images"][image_filename]
+        manifest.get("peak_rss", {}).pop(image_filename, None)
+        hash_dict.pop(f"{image_filename.split('.')[0]}.jpg", None)
+        point_dict.pop(f"{image_filename.split('.')[0]}.jpg", None)
+        colour_dict.pop(f"{image_filename.split('.')[0]}.jpg", None)
+        descriptor_dict.pop(f"{image_filename.split('.')[0]}.jpg", None)
+
+    # Delete outputs of removed images, or ones the build no longer produces
+    current_routes = {
+        route
+        for image_filename in source_filenames
+        for route in asset_routes(image_filename)
+    }
+    for route in set(asset_manifest) - current_routes:
+        remove_asset(asset_manifest, route)
+
+    digests = {
+        image_filename: file_digest(f"{original_image_path}/{image_filename}")
+        for image_filename in source_filenames
+    }
+
+    stale_filenames = [
+        image_filename
+        for image_filename in source_filenames
+        if manifest["images"].get(image_filename) != digests[image_filename]
+        or f"{image_filename.split('.')[0]}.jpg" not in hash_dict
+        or f"{image_filename.split('.')[0]}.jpg" not in descriptor_dict
+        or not all(
+            route in asset_manifest
+            and all(os.path.exists(f".{f}") for f in asset_files(asset_manifest[route]))
+            for route in asset_routes(image_filename)
+        )
+    ]
+
+    print(f"{len(stale_filenames)} of {len(source_filenames)} images to process")
+
+    # Peak memory of each image, as last processed, kept with the manifest
+    peak_rss_bytes = manifest.setdefault("peak_rss", {})
+    processed_filenames = []
+    with Pool(
+        args.workers,
+        initializer=init_worker,
+        initargs=(HASH_PARAMS, MAX_DETECT_SIZE),
+    ) as pool:
+        for image_filename, hashes, points, colours, descriptors, assets, rss in tqdm(
+            pool.imap_unordered(process_image, stale_filenames),
+            total=len(stale_filenames),
+        ):
+            peak_rss_bytes[image_filename] = rss
+            processed_filenames.append(image_filename)
+            hash_dict[f"{image_filename.split('.')[0]}.jpg"] = hashes
+            point_dict[f"{image_filename.split('.')[0]}.jpg"] = points
+            colour_dict[f"{image_filename.split('.')[0]}.jpg"] = colours
+            descriptor_dict[f"{image_filename.split('.')[0]}.jpg"] = descriptors
+            manifest["images"][image_filename] = digests[image_filename]
+
+            for route, entry in assets.items():
+                remove_asset(asset_manifest, route, keep=asset_files(entry))
+                asset_manifest[route] = entry
+
+    # A worker's peak while it processed each image, so the largest frames show.
+    # Every image's is in the build manifest
+    processed_rss = {
+        image_filename: peak_rss_bytes[image_filename]
+        for image_filename in processed_filenames
+        if peak_rss_bytes[image_filename] is not None
+    }
+    if processed_rss:
+        for image_filename in sorted(processed_rss, key=processed_rss.get)[-5:]:
+            with Image.open(f"{original_image_path}/{image_filename}") as im:
+                print(
+                    f"{image_filename} ({im.width}x{im.height}): "
+                    f"peak RSS {processed_rss[image_filename] / 1e6:.0f}MB"
+                )
+        print(
+            f"Median peak RSS per image "
+            f"{np.median(list(processed_rss.values())) / 1e6:.0f}MB, "
+            f"all in {MANIFEST_PATH}"
+        )
 
-    pil_image = Image.fromarray(cv.cvtColor(kp_img, cv.COLOR_BGR2RGB))
-    pil_image.thumbnail((MAX_IMG_WIDTH, MAX_IMG_HEIGHT))
-    pil_image.save(
-        f"./assets/imgs_kps/{name}-kps.jpg", quality=50, progressive=True, optimize=True
+    frame_names = sort_images(glob_re("frame\d+-full.\w+", list(hash_dict)))
+    write_hash_store(
+        hash_store_path,
+        hash_dict,
+        frame_names,
+        HASH_PARAMS,
+        point_dict,
+        args.max_hash_df,
+        args.shards,
+        colour_dict,
     )
+    write_descriptor_store(descriptor_store_path, descriptor_dict, frame_names)
+    write_catalog(build_catalog(sort_images(hash_dict)))
+
+    with open(MANIFEST_PATH, "w") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
 
-with open("kp_data.pickle", "wb") as file:
-    pickle.dump(hash_dict, file)
+    write_json(asset_manifest_path, asset_manifest)
+    report_variant_savings(asset_manifest)
@@ -0,0 +1,31 @@
+import multiprocessing
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:80")
+
+# Matching is CPU bound, so one process per core, with threads to keep a core
+# busy while other requests wait on the network
+worker_class = "gthread"
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+timeout = 60
+
+# Import the app, and with it the stores, once in the master so the workers
+# share those pages copy-on-write
+preload_app = True
+
+
+def when_ready(server):
+    # Lazily built structures are built before fork too, rather than per worker.
+    # scikit-learn is left for each worker's first upload, as importing it here
+    # would delay every start by more than half a second
+    from app import app
+    from matching import get_descriptor_store, get_hash_store
+
+    get_hash_store().incidence
+    # Building the descriptor scorer's KD-forest takes about two seconds
+    get_descriptor_store().flann
+
+    # Dash registers its callbacks on the first request, which concurrent threads
+    # could otherwise see half done
+    app.server.test_client().get("/_dash-dependencies")
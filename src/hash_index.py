@@ -0,0 +1,421 @@
+import hashlib
+import json
+import os
+import shutil
+from collections import namedtuple
+
+import numpy as np
+
+# Bit widths of the packed hash fields, most significant first
+HASH_FIELDS = ("a1", "a2", "s1", "s2", "a12", "d12")
+HASH_FIELD_BITS = (9, 9, 12, 12, 8, 14)
+# Hashes in at most this many frames are never stop hashes, so a small corpus,
+# where max_df of the frames is under two, still keeps the hashes frames share
+MIN_STOP_DF = 2
+
+InvertedIndex = namedtuple("InvertedIndex", ["keys", "offsets", "frame_ids", "weights"])
+
+
+def pack_fields(fields, clip=True):
+    # Pack six integer-valued fields per row into one uint64. Values beyond a
+    # field's bits are clamped to its last bin, or refused unless clip is set
+    hashes = np.zeros(len(fields), dtype=np.uint64)
+    for column, field, bits in zip(fields.T, HASH_FIELDS, HASH_FIELD_BITS):
+        if not clip and len(column) and column.max() > 2**bits - 1:
+            raise ValueError(
+                f"{field} values reach {column.max():.0f}, past its {bits} bits; "
+                "use a coarser quantization step"
+            )
+
+        column = np.clip(column, 0, 2**bits - 1).astype(np.uint64)
+        hashes = (hashes << np.uint64(bits)) | column
+
+    return hashes
+
+
+def pack_hashes(fields, return_index=False, clip=True):
+    # Quantize each field to an integer and pack the six of them into one uint64
+    fields = np.round(np.asarray(fields, dtype=float).reshape(-1, 6))
+    return np.unique(pack_fields(fields, clip), return_index=return_index)
+
+
+def probe_hashes(fields, probe_fields, return_index=False):
+    # Besides its own bin, each probed field also tries the adjacent bin its value
+    # is closest to, so values near a bin edge still meet their match
+    fields = np.asarray(fields, dtype=float).reshape(-1, 6)
+    rounded = np.round(fields)
+    adjacent = rounded + np.where(fields >= rounded, 1, -1)
+
+    probes = [rounded]
+    for field in probe_fields:
+        column = HASH_FIELDS.index(field)
+        for probe in list(probes):
+            probe = probe.copy()
+            probe[:, column] = adjacent[:, column]
+            probes.append(probe)
+
+    hashes = np.concatenate([pack_fields(probe) for probe in probes])
+    if return_index:
+        # Index of the fields row each unique hash was probed from
+        hashes, index = np.unique(hashes, return_index=True)
+        return hashes, index % len(fields)
+
+    return np.unique(hashes)
+
+
+def build_inverted_index(hash_dict, frame_names, max_df=None):
+    # Sorted hash keys, each owning a slice of frame ids delimited by offsets, and
+    # an IDF weight per key. Stop hashes, in more than max_df of the frames and
+    # more than MIN_STOP_DF frames, are left out altogether
+    hashes = [hash_dict[frame_name] for frame_name in frame_names]
+    frame_ids = np.repeat(
+        np.arange(len(hashes), dtype=np.int32), [len(h) for h in hashes]
+    )
+    all_hashes = np.concatenate(hashes) if hashes else np.array([], dtype=np.uint64)
+
+    order = np.argsort(all_hashes, kind="stable")
+    keys, counts = np.unique(all_hashes[order], return_counts=True)
+    frame_ids = frame_ids[order]
+
+    if max_df is not None:
+        keep = counts <= max(max_df * len(frame_names), MIN_STOP_DF)
+        keys, counts, frame_ids = (
+            keys[keep],
+            counts[keep],
+            frame_ids[np.repeat(keep, counts)],
+        )
+
+    # Each frame holds a hash at most once, so counts are document frequencies
+    offsets = np.append(0, np.cumsum(counts)).astype(np.int64)
+    weights = np.log(len(frame_names) / counts).astype(np.float32)
+
+    return InvertedIndex(keys, offsets, frame_ids, weights)
+
+
+def lookup_keys(keys, hashes):
+    # Positions in keys of the distinct query hashes present in the index
+    hashes = np.unique(hashes)
+
+    pos = np.searchsorted(keys, hashes)
+    found = pos < len(keys)
+    found[found] = keys[pos[found]] == hashes[found]
+    return pos[found]
+
+
+def score_frames(index, hashes, n_frames, frame_mask=None):
+    # A vote per distinct query hash for every frame that contains it, weighted by
+    # how rare the hash is. Given a mask, only the frames in it are scored
+    keys, offsets, frame_ids, weights = index
+    pos = lookup_keys(keys, hashes)
+
+    # Gather the postings of every matched key in one go
+    starts, lengths = offsets[pos], offsets[pos + 1] - offsets[pos]
+    postings = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    postings += np.arange(len(postings))
+    posting_frames = frame_ids[postings]
+    posting_weights = np.repeat(weights[pos], lengths)
+
+    if frame_mask is not None:
+        in_mask = frame_mask[posting_frames]
+        posting_frames, posting_weights = (
+            posting_frames[in_mask],
+            posting_weights[in_mask],
+        )
+
+    return np.bincount(posting_frames, weights=posting_weights, minlength=n_frames)
+
+
+def top_frames(scores, n, first_frame=0):
+    # Frames with a positive score, best first and lowest frame first among ties,
+    # so top frames taken per shard merge into exactly the whole index's
+    frames = np.flatnonzero(scores > 0)
+
+    # Partially select the n best in linear time before sorting only those,
+    # keeping every frame tied with the nth so the ties still break by frame
+    if len(frames) > n:
+        nth = -np.partition(-scores[frames], n - 1)[n - 1]
+        frames = frames[scores[frames] >= nth]
+
+    order = np.lexsort((frames, -scores[frames]))[:n]
+    return frames[order] + first_frame, scores[frames[order]]
+
+
+def merge_top_frames(results, n):
+    frames = np.concatenate([frames for frames, _ in results])
+    scores = np.concatenate([scores for _, scores in results])
+    order = np.lexsort((frames, -scores))[:n]
+    return frames[order], scores[order]
+
+
+def split_index(index, n_frames, n_shards):
+    # Partition the postings into contiguous frame ranges with frame ids local to
+    # each, keeping the global IDF weights so a frame scores as in the whole index
+    keys, offsets, frame_ids, weights = index
+    key_ids = np.repeat(np.arange(len(keys)), np.diff(offsets))
+    bounds = np.linspace(0, n_frames, n_shards + 1).astype(int)
+
+    shards = []
+    for first_frame, last_frame in zip(bounds[:-1], bounds[1:]):
+        in_shard = (frame_ids >= first_frame) & (frame_ids < last_frame)
+        shard_keys, counts = np.unique(key_ids[in_shard], return_counts=True)
+        shard = InvertedIndex(
+            keys[shard_keys],
+            np.append(0, np.cumsum(counts)).astype(np.int64),
+            (frame_ids[in_shard] - first_frame).astype(np.int32),
+            weights[shard_keys],
+        )
+        shards.append((int(first_frame), int(last_frame - first_frame), shard))
+
+    return shards
+
+
+class HashStore:
+    # Per-image hash arrays and the frame index, memory-mapped from a store directory
+    def __init__(
+        self,
+        names,
+        frame_names,
+        hashes,
+        offsets,
+        index,
+        version,
+        params=None,
+        points=None,
+        shards=1,
+        colours=None,
+        max_df=None,
+    ):
+        self.names = names
+        self.frame_names = frame_names
+        self.hashes = hashes
+        self.offsets = offsets
+        self.index = index
+        self.version = version
+        # The hashing parameters the store was built with, which queries must share
+        self.params = params
+        # Image position of the keypoint pair behind each hash, for verification
+        self.points = points
+        # Frame range partitions of the index, stored under shards/ when above one
+        self.shards = shards
+        # Packed colour signature of each image, for the prefilter
+        self.colours = colours
+        # Stop hash cutoff the index was built with, see build_inverted_index
+        self.max_df = max_df
+
+        self._positions = {name: i for i, name in enumerate(names)}
+        self._incidence = None
+        self._frame_colours = None
+
+    def __contains__(self, name):
+        return name in self._positions
+
+    def __getitem__(self, name):
+        i = self._positions[name]
+        return self.hashes[self.offsets[i] : self.offsets[i + 1]]
+
+    def hash_points(self, name):
+        if self.points is None:
+            return None
+
+        i = self._positions[name]
+        return self.points[self.offsets[i] : self.offsets[i + 1]]
+
+    def image_colours(self, name):
+        if self.colours is None:
+            return None
+
+        return self.colours[self._positions[name]]
+
+    @property
+    def frame_colours(self):
+        # Colour signatures in frame order, gathered on first use
+        if self._frame_colours is None and self.colours is not None:
+            self._frame_colours = np.array(
+                self.colours[[self._positions[name] for name in self.frame_names]]
+            )
+
+        return self._frame_colours
+
+    def to_dict(self):
+        return {name: np.array(self[name]) for name in self.names}
+
+    def points_dict(self):
+        return {name: np.array(self.hash_points(name)) for name in self.names}
+
+    def colours_dict(self):
+        return {name: np.array(self.image_colours(name)) for name in self.names}
+
+    def score(self, hashes, frame_mask=None):
+        return score_frames(self.index, hashes, len(self.frame_names), frame_mask)
+
+    @property
+    def incidence(self):
+        # Sparse key x frame matrix over the index postings, built on first use;
+        # scipy is only imported then, as single queries never need it
+        if self._incidence is None:
+            from scipy import sparse
+
+            keys, offsets, frame_ids, weights = self.index
+            self._incidence = sparse.csr_matrix(
+                (np.repeat(weights, np.diff(offsets)), frame_ids, offsets),
+                shape=(len(keys), len(self.frame_names)),
+            )
+
+        return self._incidence
+
+    def score_batch(self, hash_lists):
+        # Query x key incidence times key x frame incidence scores every query at once
+        from scipy import sparse
+
+        key_pos = [lookup_keys(self.index.keys, hashes) for hashes in hash_lists]
+        indptr = np.append(0, np.cumsum([len(pos) for pos in key_pos]))
+        queries = sparse.csr_matrix(
+            (
+                np.ones(indptr[-1], dtype=np.float32),
+                np.concatenate(key_pos) if key_pos else np.array([], dtype=np.int64),
+                indptr,
+            ),
+            shape=(len(hash_lists), len(self.index.keys)),
+        )
+
+        return (queries @ self.incidence).toarray()
+
+
+def save_arrays(path, arrays, meta):
+    os.makedirs(path, exist_ok=True)
+
+    # Replace files rather than rewriting them, so open mmaps keep the old data
+    for field, array in arrays.items():
+        np.save(f"{path}/{field}.tmp.npy", array)
+        os.replace(f"{path}/{field}.tmp.npy", f"{path}/{field}.npy")
+
+    with open(f"{path}/meta.json.tmp", "w") as file:
+        json.dump(meta, file)
+    os.replace(f"{path}/meta.json.tmp", f"{path}/meta.json")
+
+
+def write_index_shards(path, index, n_frames, n_shards):
+    for i, (first_frame, shard_frames, shard) in enumerate(
+        split_index(index, n_frames, n_shards)
+    ):
+        save_arrays(
+            f"{path}/shards/{i}",
+            {f"index_{field}": array for field, array in shard._asdict().items()},
+            {"first_frame": first_frame, "n_frames": shard_frames},
+        )
+
+    # Shards beyond the count are left from an earlier build
+    if os.path.isdir(f"{path}/shards"):
+        for name in os.listdir(f"{path}/shards"):
+            if int(name) >= n_shards:
+                shutil.rmtree(f"{path}/shards/{name}")
+
+
+def write_hash_store(
+    path,
+    hash_dict,
+    frame_names,
+    params=None,
+    point_dict=None,
+    max_df=None,
+    n_shards=1,
+    colour_dict=None,
+):
+    names = sorted(hash_dict)
+    hashes = [hash_dict[name] for name in names]
+
+    arrays = {
+        "hashes": np.concatenate(hashes) if hashes else np.array([], dtype=np.uint64),
+        "offsets": np.append(0, np.cumsum([len(h) for h in hashes])).astype(np.int64),
+    }
+    if point_dict is not None:
+        points = [point_dict[name] for name in names]
+        arrays["points"] = (
+            np.concatenate(points).astype(np.float32)
+            if points
+            else np.zeros((0, 2), dtype=np.float32)
+        )
+
+    if colour_dict is not None:
+        arrays["colours"] = np.array(
+            [colour_dict[name] for name in names], dtype=np.uint8
+        ).reshape(len(names), -1)
+
+    index = build_inverted_index(hash_dict, frame_names, max_df)
+    arrays.update({f"index_{field}": array for field, array in index._asdict().items()})
+
+    version = hashlib.sha256(json.dumps([names, frame_names, params, max_df]).encode())
+    for array in arrays.values():
+        version.update(array.tobytes())
+
+    # Shards go first, as the app reopens the store once its meta.json is replaced.
+    # A single shard is the index itself, so none are written
+    write_index_shards(path, index, len(frame_names), n_shards if n_shards > 1 else 0)
+    save_arrays(
+        path,
+        arrays,
+        {
+            "version": version.hexdigest(),
+            "names": names,
+            "frame_names": frame_names,
+            "params": params,
+            "points": point_dict is not None,
+            "max_df": max_df,
+            "shards": n_shards,
+            "colours": colour_dict is not None,
+        },
+    )
+
+
+def open_hash_store(path):
+    with open(f"{path}/meta.json") as file:
+        meta = json.load(file)
+
+    arrays = {
+        field: np.load(f"{path}/{field}.npy", mmap_mode="r")
+        for field in [
+            "hashes",
+            "offsets",
+            "index_keys",
+            "index_offsets",
+            "index_frame_ids",
+        ]
+    }
+
+    # Stores from before IDF weighting score every hash the same
+    if os.path.exists(f"{path}/index_weights.npy"):
+        weights = np.load(f"{path}/index_weights.npy", mmap_mode="r")
+    else:
+        weights = np.ones(len(arrays["index_keys"]), dtype=np.float32)
+
+    return HashStore(
+        meta["names"],
+        meta["frame_names"],
+        arrays["hashes"],
+        arrays["offsets"],
+        InvertedIndex(
+            arrays["index_keys"],
+            arrays["index_offsets"],
+            arrays["index_frame_ids"],
+            weights,
+        ),
+        meta["version"],
+        meta.get("params"),
+        np.load(f"{path}/points.npy", mmap_mode="r") if meta.get("points") else None,
+        meta.get("shards", 1),
+        np.load(f"{path}/colours.npy", mmap_mode="r") if meta.get("colours") else None,
+        meta.get("max_df"),
+    )
+
+
+def open_index_shard(path):
+    with open(f"{path}/meta.json") as file:
+        meta = json.load(file)
+
+    index = InvertedIndex(
+        *(
+            np.load(f"{path}/index_{field}.npy", mmap_mode="r")
+            for field in InvertedIndex._fields
+        )
+    )
+    return meta["first_frame"], meta["n_frames"], index
@@ -0,0 +1,133 @@
+import cv2 as cv
+import numpy as np
+from PIL import Image
+
+from hash_index import pack_hashes, probe_hashes
+
+N_NEIGHBORS = 5
+# Quantization steps, in degrees for angles and in sizes and distances' units
+DEG_QUANT_F = 3
+SIZE_QUANT_F = 0.2
+DIST_QUANT_F = 1
+# Measure the second size and the distance in units of the first keypoint's size
+# instead of pixels, so hashes survive the hint being rescaled
+SCALE_INVARIANT = True
+
+HASH_PARAMS = {
+    "n_neighbors": N_NEIGHBORS,
+    "deg_quant_f": DEG_QUANT_F,
+    "size_quant_f": SIZE_QUANT_F,
+    "dist_quant_f": DIST_QUANT_F,
+    "scale_invariant": SCALE_INVARIANT,
+}
+
+MAX_IMG_WIDTH = 1080
+MAX_IMG_HEIGHT = 1080
+
+
+def load_gray(fp, size=None, max_pixels=None):
+    # A single grayscale copy, with the factor from its pixels back to the source's.
+    # Given a size box, JPEGs decode straight to their luma at a reduced scale.
+    # Otherwise they decode in colour and are converted, as the luma differs
+    # slightly and costs a hint match on the bundled images
+    with Image.open(fp) as im:
+        # Oversized images are refused from their header, before any decoding
+        if max_pixels and im.width * im.height > max_pixels:
+            raise Image.DecompressionBombError(
+                f"{im.width}x{im.height} image exceeds {max_pixels} pixels"
+            )
+
+        width = im.width
+        if size:
+            im.draft("L", size)
+        gray = im.convert("L")
+
+    if size:
+        gray.thumbnail(size)
+
+    return np.asarray(gray), width / gray.width
+
+
+def scale_keypoints(kps, scale):
+    if scale == 1:
+        return kps
+
+    return [
+        cv.KeyPoint(kp.pt[0] * scale, kp.pt[1] * scale, kp.size * scale, kp.angle)
+        for kp in kps
+    ]
+
+
+def angles(p1, p2):
+    # Angle of each p1 -> p2 vector from the y axis, 0 where the points coincide
+    x2 = p2 - p1
+    same = np.isclose(p1, p2).all(axis=1)
+
+    norms = np.linalg.norm(x2[~same], axis=1)
+    result = np.zeros(len(p1))
+    result[~same] = np.arccos(x2[~same, 1] / norms)
+    return result
+
+
+def hash_fields(kps, params=HASH_PARAMS):
+    # Unrounded (a1, a2, s1, s2, a12, d12) of each keypoint and neighbour pair,
+    # already divided by their quantization steps, and the pair's midpoint
+    n_neighbors = params["n_neighbors"]
+
+    # kneighbors needs at least one keypoint beyond the neighbours of each point
+    if len(kps) < 1 + n_neighbors:
+        return np.zeros((0, 6)), np.zeros((0, 2))
+
+    # scikit-learn takes longer to import than the rest of the app's query path, so
+    # it is only imported once hashes are first needed
+    from sklearn.neighbors import NearestNeighbors
+
+    kp_array = np.array([kp.pt for kp in kps])
+    kp_angles = np.array([kp.angle for kp in kps]) / params["deg_quant_f"]
+    kp_sizes = np.array([kp.size for kp in kps])
+
+    neigh = NearestNeighbors(n_neighbors=1 + n_neighbors)
+    neigh.fit(kp_array)
+    _, knn_inds = neigh.kneighbors(kp_array)
+
+    # Pair every keypoint with each of its neighbours, skipping itself
+    inds1 = np.repeat(np.arange(len(kps)), 1 + n_neighbors)
+    inds2 = knn_inds.ravel()
+    inds1, inds2 = inds1[inds1 != inds2], inds2[inds1 != inds2]
+
+    kp1_pts, kp2_pts = kp_array[inds1], kp_array[inds2]
+
+    a12 = np.rad2deg(angles(kp1_pts, kp2_pts)) / params["deg_quant_f"]
+    d12 = np.linalg.norm(kp1_pts - kp2_pts, axis=1)
+    s1, s2 = kp_sizes[inds1], kp_sizes[inds2]
+
+    if params["scale_invariant"]:
+        s1, s2, d12 = np.zeros(len(s1)), s2 / s1, d12 / s1
+
+    fields = np.column_stack(
+        (
+            kp_angles[inds1],
+            kp_angles[inds2],
+            s1 / params["size_quant_f"],
+            s2 / params["size_quant_f"],
+            a12,
+            d12 / params["dist_quant_f"],
+        )
+    )
+    return fields, (kp1_pts + kp2_pts) / 2
+
+
+def get_hashes(
+    kps, params=HASH_PARAMS, probe_fields=(), return_points=False, clip=True
+):
+    # Queries clip fields to their bits, while the build refuses to, see pack_fields
+    fields, points = hash_fields(kps, params)
+    if probe_fields:
+        hashes, index = probe_hashes(fields, probe_fields, return_index=True)
+    else:
+        hashes, index = pack_hashes(fields, return_index=True, clip=clip)
+
+    if return_points:
+        return hashes, points[index]
+
+    return hashes
@@ -0,0 +1,153 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from catalog import get_catalog, load_json
+from util import asset_manifest_path, original_image_path
+
+# The update_results callback on the index page, which runs the frame match
+MATCH_OUTPUTS = [
+    ("test_image_link", "children"),
+    ("test_image_link", "href"),
+    ("source_image_link", "children"),
+    ("source_image_link", "href"),
+    ("match-list", "children"),
+    ("keypoint-data", "data"),
+]
+
+
+def match_request(base_url, frame_no, hint_no):
+    body = {
+        "output": "..{}..".format(
+            "...".join(f"{id}.{property}" for id, property in MATCH_OUTPUTS)
+        ),
+        "outputs": [{"id": id, "property": property} for id, property in MATCH_OUTPUTS],
+        "inputs": [
+            {"id": "frame", "property": "value", "value": frame_no},
+            {"id": "hint-num", "property": "value", "value": hint_no},
+        ],
+        "changedPropIds": ["frame.value"],
+        # As on a first load, with no best frame shown yet
+        "state": [{"id": "source_image_link", "property": "href"}],
+    }
+    return urllib.request.Request(
+        f"{base_url}/_dash-update-component",
+        data=json.dumps(body).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+
+
+def request_factories(base_url):
+    # Each kind of request makes a fresh request from the bundled frames and hints
+    catalog = get_catalog()
+    hints = [
+        (frame_no, hint_no)
+        for frame_no, entry in catalog.items()
+        for hint_no in range(1, entry["hints"] + 1)
+    ]
+    assets = [
+        variant["url"]
+        for entry in load_json(asset_manifest_path).values()
+        for variant in entry["variants"]
+    ]
+    hint_files = [
+        name for name in os.listdir(original_image_path) if "-full" not in name
+    ]
+
+    def upload():
+        with open(f"{original_image_path}/{random.choice(hint_files)}", "rb") as file:
+            return urllib.request.Request(
+                f"{base_url}/api/match",
+                data=file.read(),
+                headers={"Content-Type": "application/octet-stream"},
+            )
+
+    return {
+        "page": lambda: urllib.request.Request(f"{base_url}/"),
+        "match": lambda: match_request(base_url, *random.choice(hints)),
+        "asset": lambda: urllib.request.Request(f"{base_url}{random.choice(assets)}"),
+        "upload": upload,
+    }
+
+
+def timed_request(kind, request):
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            response.read()
+        ok = True
+    except OSError:
+        ok = False
+
+    return kind, ok, time.perf_counter() - start
+
+
+def summarize(latencies):
+    latencies = np.array(latencies)
+    return {
+        "requests": len(latencies),
+        "p50_ms": 1000 * np.percentile(latencies, 50) if len(latencies) else None,
+        "p99_ms": 1000 * np.percentile(latencies, 99) if len(latencies) else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load the app with concurrent page, match, asset and upload requests"
+    )
+    parser.add_argument("--url", default="http://127.0.0.1:8050")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument(
+        "--mix",
+        nargs="+",
+        choices=["page", "match", "asset", "upload"],
+        default=["page", "match", "match", "asset", "asset", "asset", "upload"],
+        help="request kinds, cycled in order; repeat a kind to weight it",
+    )
+    parser.add_argument("--out", help="write the results as JSON")
+    args = parser.parse_args()
+
+    factories = request_factories(args.url.rstrip("/"))
+    kinds = itertools.islice(itertools.cycle(args.mix), args.requests)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        results = list(
+            executor.map(lambda kind: timed_request(kind, factories[kind]()), kinds)
+        )
+    elapsed = time.perf_counter() - start
+
+    report = {
+        "url": args.url,
+        "concurrency": args.concurrency,
+        "seconds": elapsed,
+        "requests_per_second": len(results) / elapsed,
+        "errors": sum(not ok for _, ok, _ in results),
+        "kinds": {
+            kind: summarize([t for k, ok, t in results if k == kind and ok])
+            for kind in sorted(set(args.mix))
+        },
+    }
+    report["all"] = summarize([t for _, ok, t in results if ok])
+
+    for kind, stats in list(report["kinds"].items()) + [("all", report["all"])]:
+        if not stats["requests"]:
+            print(f"{kind}: no successful requests")
+            continue
+        print(
+            f"{kind}: {stats['requests']} requests, "
+            f"p50 {stats['p50_ms']:.1f}ms, p99 {stats['p99_ms']:.1f}ms"
+        )
+    print(f"{report['requests_per_second']:.1f} requests/s, {report['errors']} errors")
+
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(report, file, indent=2)
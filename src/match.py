@@ -0,0 +1,58 @@
+import argparse
+import json
+import sys
+import time
+
+from matching import extract_hashes, get_hash_store, rank_hashes_batch
+from util import frame_number
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rank frame matches for many hint images at once"
+    )
+    parser.add_argument("hints", nargs="+", help="hint image files")
+    parser.add_argument(
+        "--names",
+        action="store_true",
+        help="treat hints as image names already in the hash store, e.g. frame18-1.jpg",
+    )
+    args = parser.parse_args()
+
+    hash_store = get_hash_store()
+
+    start = time.perf_counter()
+    if args.names:
+        hash_lists = [hash_store[name] for name in args.hints]
+        point_lists = [hash_store.hash_points(name) for name in args.hints]
+    else:
+        hash_lists, point_lists = [], []
+        for path in args.hints:
+            with open(path, "rb") as file:
+                hashes, points = extract_hashes(file.read())
+            hash_lists.append(hashes)
+            point_lists.append(points)
+    extract_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = rank_hashes_batch(hash_lists, point_lists)
+    match_time = time.perf_counter() - start
+
+    for hint, matches in zip(args.hints, results):
+        matches = [
+            {
+                "frame": frame_number(hash_store.frame_names[match.frame]),
+                "score": match.score,
+                "inliers": match.inliers,
+                "confidence": match.confidence,
+            }
+            for match in matches
+        ]
+        print(json.dumps({"hint": hint, "matches": matches}))
+
+    n_queries = len(hash_lists)
+    print(
+        f"{n_queries} queries: extract {extract_time:.3f}s, match {match_time:.3f}s, "
+        f"{n_queries / (extract_time + match_time):.1f} queries/s "
+        f"({n_queries / match_time:.1f} queries/s matching only)",
+        file=sys.stderr,
+    )
@@ -0,0 +1,262 @@
+import io
+import os
+import threading
+from collections import namedtuple
+from functools import lru_cache
+
+import cv2 as cv
+import numpy as np
+
+from descriptor_index import open_descriptor_store, quantize_descriptors
+from hash_index import open_hash_store, top_frames
+from hashing import (
+    HASH_PARAMS,
+    MAX_IMG_HEIGHT,
+    MAX_IMG_WIDTH,
+    get_hashes,
+    load_gray,
+    scale_keypoints,
+)
+from metrics import timed
+from prefilter import prefilter_frames, read_colour_signature
+from shard_pool import ShardPool
+from util import descriptor_store_path, hash_store_path
+
+N_MATCHES = 10
+# Frames by hash overlap that go on to geometric verification
+N_CANDIDATES = 20
+# How far (px) an inlier may land from its transformed match, and the fewest
+# inliers that count, as RANSAC fits a few chance pairs in any frame
+RANSAC_THRESHOLD = 5.0
+MIN_INLIERS = 6
+RESULT_CACHE_SIZE = 4096
+# Largest upload decoded, an 8K image. Pillow only refuses images twice its own
+# warning limit of about 89M pixels
+MAX_UPLOAD_PIXELS = 7680 * 4320
+# Hash fields whose adjacent bins are also probed for uploaded images, see
+# evaluate.py; with scale invariant hashes probing has not paid for itself
+PROBE_FIELDS = ()
+# Fraction of frames, by shared colours, that go on to hash scoring; None scores
+# every frame. See the prefilter section of benchmark.py for its recall
+PREFILTER_KEEP = None
+
+# Frames are scored by shared pair hashes, or by ratio-tested descriptor votes
+SCORERS = ("hashes", "descriptors")
+
+# Inliers and confidence are None for matches that were not verified
+Match = namedtuple("Match", ["frame", "score", "inliers", "confidence"])
+
+_local = threading.local()
+# Each store by path, with the modification time of the meta.json it was opened at
+_stores = {}
+# Pools by shard count, for stores built with --shards
+_shard_pools = {}
+
+
+def load_store(path, open_store):
+    # Reopen only when generate_data.py has written a new version of the store, so
+    # rankings follow the catalog, which is reloaded the same way
+    mtime = os.stat(f"{path}/meta.json").st_mtime_ns
+    if path not in _stores or _stores[path][0] != mtime:
+        _stores[path] = mtime, open_store(path)
+
+    return _stores[path][1]
+
+
+def get_hash_store():
+    return load_store(hash_store_path, open_hash_store)
+
+
+def get_descriptor_store():
+    return load_store(descriptor_store_path, open_descriptor_store)
+
+
+def get_shard_pool():
+    # Stores built with --shards are scored a shard per process
+    n_shards = get_hash_store().shards
+    if n_shards <= 1:
+        return None
+
+    if n_shards not in _shard_pools:
+        _shard_pools[n_shards] = ShardPool(hash_store_path, n_shards)
+
+    return _shard_pools[n_shards]
+
+
+def get_sift():
+    # SIFT instances are reused across requests, one per worker thread
+    if not hasattr(_local, "sift"):
+        _local.sift = cv.SIFT_create()
+
+    return _local.sift
+
+
+def extract_keypoints(data, descriptors=False):
+    # Large JPEGs are decoded at a reduced scale before the thumbnail resize
+    gray, scale = load_gray(
+        io.BytesIO(data), (MAX_IMG_WIDTH, MAX_IMG_HEIGHT), MAX_UPLOAD_PIXELS
+    )
+    if descriptors:
+        kps, descriptors = get_sift().detectAndCompute(gray, None)
+    else:
+        kps = get_sift().detect(gray, None)
+
+    # Hashes are in pixel units, so map keypoints back to the uploaded resolution
+    return scale_keypoints(kps, scale), descriptors
+
+
+def extract_hashes(data):
+    # Query hashes and the image position of each, for verification
+    kps, _ = extract_keypoints(data)
+    return get_hashes(
+        kps, get_hash_store().params or HASH_PARAMS, PROBE_FIELDS, return_points=True
+    )
+
+
+def extract_colours(data):
+    return read_colour_signature(io.BytesIO(data))
+
+
+def extract_descriptors(data):
+    _, descriptors = extract_keypoints(data, descriptors=True)
+    return quantize_descriptors(descriptors)
+
+
+def frame_matches(frames, scores):
+    return tuple(
+        Match(int(frame), round(float(score), 2), None, None)
+        for frame, score in zip(frames, scores)
+    )
+
+
+def top_matches(hash_overlaps, n=N_MATCHES):
+    return frame_matches(*top_frames(hash_overlaps, n))
+
+
+def top_hash_matches(hashes, n=N_MATCHES, colours=None):
+    hash_store, shard_pool = get_hash_store(), get_shard_pool()
+    if shard_pool is None:
+        frame_mask = None
+        if PREFILTER_KEEP and colours is not None and hash_store.colours is not None:
+            with timed("frame_game_stage_seconds", stage="prefilter"):
+                frame_mask = prefilter_frames(
+                    colours, hash_store.frame_colours, PREFILTER_KEEP
+                )
+
+        with timed("frame_game_stage_seconds", stage="score"):
+            hash_overlaps = hash_store.score(hashes, frame_mask)
+        with timed("frame_game_stage_seconds", stage="rank"):
+            return top_matches(hash_overlaps, n)
+
+    with timed("frame_game_stage_seconds", stage="shards"):
+        return frame_matches(*shard_pool.top_frames(hashes, n))
+
+
+def count_inliers(hashes, points, frame_name):
+    # Shared hashes whose positions agree on one similarity transform
+    hash_store = get_hash_store()
+    frame_hashes = hash_store[frame_name]
+    frame_pos = np.searchsorted(frame_hashes, hashes)
+    found = frame_pos < len(frame_hashes)
+    found[found] = frame_hashes[frame_pos[found]] == hashes[found]
+    query_pos, frame_pos = np.flatnonzero(found), frame_pos[found]
+    if len(query_pos) < MIN_INLIERS:
+        return 0
+
+    _, inliers = cv.estimateAffinePartial2D(
+        np.asarray(points, dtype=np.float32)[query_pos],
+        np.asarray(hash_store.hash_points(frame_name), dtype=np.float32)[frame_pos],
+        method=cv.RANSAC,
+        ransacReprojThreshold=RANSAC_THRESHOLD,
+    )
+    n_inliers = 0 if inliers is None else int(inliers.sum())
+    return n_inliers if n_inliers >= MIN_INLIERS else 0
+
+
+def verify_matches(candidates, hashes, points):
+    # Re-rank candidates by inliers, with each one's share of all the candidates'
+    # inliers as its confidence
+    frame_names = get_hash_store().frame_names
+    inliers = [
+        count_inliers(hashes, points, frame_names[match.frame]) for match in candidates
+    ]
+    total = sum(inliers)
+
+    verified = sorted(
+        (
+            match._replace(inliers=n, confidence=n / total if total else 0.0)
+            for match, n in zip(candidates, inliers)
+        ),
+        key=lambda match: (match.inliers, match.score),
+        reverse=True,
+    )
+    return tuple(verified[:N_MATCHES])
+
+
+def rank_hashes(hashes, points=None, colours=None):
+    # Best matches for a set of query hashes, verified when their points are known,
+    # and prefiltered by colour when the query's colour signature is given
+    if points is None or get_hash_store().points is None:
+        return top_hash_matches(hashes, colours=colours)
+
+    candidates = top_hash_matches(hashes, N_CANDIDATES, colours)
+    with timed("frame_game_stage_seconds", stage="verify"):
+        return verify_matches(candidates, hashes, points)
+
+
+def rank_descriptors(descriptors):
+    return top_matches(get_descriptor_store().score(descriptors))
+
+
+def rank_hashes_batch(hash_lists, point_lists=None):
+    hash_store = get_hash_store()
+    if point_lists is None or hash_store.points is None:
+        return [
+            top_matches(hash_overlaps)
+            for hash_overlaps in hash_store.score_batch(hash_lists)
+        ]
+
+    return [
+        verify_matches(top_matches(hash_overlaps, N_CANDIDATES), hashes, points)
+        for hash_overlaps, hashes, points in zip(
+            hash_store.score_batch(hash_lists), hash_lists, point_lists
+        )
+    ]
+
+
+@lru_cache(maxsize=RESULT_CACHE_SIZE)
+def rank_frames(image_name, scorer, store_version):
+    # The store version is only part of the cache key, so rankings from before the
+    # store was rebuilt are not served after it is reopened
+    if scorer == "descriptors":
+        return rank_descriptors(get_descriptor_store()[image_name])
+
+    hash_store = get_hash_store()
+    return rank_hashes(
+        hash_store[image_name],
+        hash_store.hash_points(image_name),
+        hash_store.image_colours(image_name),
+    )
+
+
+def match_image(image_name, scorer="hashes"):
+    store = get_descriptor_store() if scorer == "descriptors" else get_hash_store()
+    return rank_frames(image_name, scorer, store.version)
+
+
+def cache_stats():
+    return rank_frames.cache_info()._asdict()
+
+
+def index_stats():
+    hash_store = get_hash_store()
+    return {
+        "images": len(hash_store.names),
+        "frames": len(hash_store.frame_names),
+        "index_keys": len(hash_store.index.keys),
+        "index_postings": len(hash_store.index.frame_ids),
+        "index_bytes": sum(array.nbytes for array in hash_store.index),
+        "hash_bytes": hash_store.hashes.nbytes
+        + (hash_store.points.nbytes if hash_store.points is not None else 0),
+        "shards": hash_store.shards,
+    }
@@ -0,0 +1,71 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (s) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+HISTOGRAMS = {
+    "frame_game_request_seconds": "Time to handle each request, by route or Dash callback",
+    "frame_game_stage_seconds": "Time spent in each stage of matching a hint",
+}
+
+_lock = threading.Lock()
+# Bucket counts, then the sum and count, per histogram and label values
+_observations = {}
+
+
+def observe(name, seconds, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        values = _observations.setdefault(key, [0] * (len(LATENCY_BUCKETS) + 2))
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                values[i] += 1
+        values[-2] += seconds
+        values[-1] += 1
+
+
+@contextmanager
+def timed(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+
+    return "{%s}" % ",".join(f'{name}="{value}"' for name, value in labels)
+
+
+def render(metrics=()):
+    # Prometheus text exposition of the histograms, followed by (name, type, help,
+    # value) metrics such as cache and index stats read at scrape time
+    with _lock:
+        observations = {key: list(values) for key, values in _observations.items()}
+
+    lines = []
+    for name, help in HISTOGRAMS.items():
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+        for (observed, labels), values in sorted(observations.items()):
+            if observed != name:
+                continue
+
+            for bound, count in zip(LATENCY_BUCKETS, values):
+                lines.append(
+                    f"{name}_bucket{format_labels(labels + (('le', bound),))} {count}"
+                )
+            lines += [
+                f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {values[-1]}",
+                f"{name}_sum{format_labels(labels)} {values[-2]}",
+                f"{name}_count{format_labels(labels)} {values[-1]}",
+            ]
+
+    for name, type, help, value in metrics:
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} {type}", f"{name} {value}"]
+
+    return "\n".join(lines) + "\n"
@@ -1,16 +1,24 @@
-import os
-import pickle
-from urllib.parse import urlencode
-
 import dash
 import dash_bootstrap_components as dbc
-import numpy as np
-import plotly.graph_objects as go
-from dash import Input, Output, State, callback, callback_context, dcc, html
+from dash import (
+    ClientsideFunction,
+    Input,
+    Output,
+    State,
+    callback,
+    callback_context,
+    clientside_callback,
+    dcc,
+    html,
+    no_update,
+)
 from dash.exceptions import PreventUpdate
 
-from app_util import apply_default_value, dash_kwarg, parse_state
-from util import glob_re, kps_image_route, sort_images, src_image_route
+from app_util import apply_default_value, parse_state
+from catalog import asset_entry, asset_url, get_catalog
+from matching import get_hash_store, match_image
+from metrics import timed
+from util import frame_number, kps_route, src_image_route
 
 #
 # def argmax(iter):
@@ -26,17 +34,53 @@ from util import glob_re, kps_image_route, sort_images, src_image_route
 
 dash.register_page(__name__, path="/", title="Frame Game Solver")
 
-list_of_images = sort_images(
-    glob_re("frame\d+-full.\w+", os.listdir(f".{src_image_route}"))
-)
 
+def responsive_image(route, sizes):
+    # Offer every generated width and format so browsers fetch the smallest adequate one
+    entry = asset_entry(route)
+    if entry is None:
+        return html.Img(src=route, className="img-fluid")
+
+    srcsets = {}
+    for variant in entry["variants"]:
+        srcsets.setdefault(variant["type"], []).append(
+            f"{variant['url']} {variant['width']}w"
+        )
+    jpeg_srcset = srcsets.pop("image/jpeg")
+
+    # Newer formats are generated last and browsers take the first source they support
+    sources = [
+        html.Source(type=type, srcSet=", ".join(srcset), sizes=sizes)
+        for type, srcset in reversed(srcsets.items())
+    ]
+    return html.Picture(
+        sources
+        + [
+            html.Img(
+                src=entry["src"],
+                srcSet=", ".join(jpeg_srcset),
+                sizes=sizes,
+                className="img-fluid",
+            )
+        ]
+    )
+
+
+def keypoint_sidecar(route):
+    entry = asset_entry(route)
+    if entry is None:
+        return None
 
-with open("kp_data.pickle", "rb") as file:
-    hash_dict = pickle.load(file)
+    return {"url": entry["src"], "width": entry["width"], "height": entry["height"]}
 
 
 def build_layout(params):
+    catalog = get_catalog()
     return [
+        dcc.Store(
+            id="hint-counts",
+            data={frame_no: entry["hints"] for frame_no, entry in catalog.items()},
+        ),
         dbc.Form(
             [
                 dbc.Row(
@@ -59,11 +103,7 @@ def build_layout(params):
                         apply_default_value(params)(dcc.Dropdown)(
                             id="frame",
                             options=[
-                                {"label": i, "value": i}
-                                for i in range(
-                                    1,
-                                    1 + len(list_of_images),
-                                )
+                                {"label": i, "value": i} for i in catalog
                             ],
                             value=1,
                             clearable=False,
@@ -92,14 +132,23 @@ def build_layout(params):
                     dbc.Col(
                         [
                             dcc.Loading(
-                                html.A(
-                                    children=[
-                                        html.Img(
-                                            id="test_image",
-                                            className="img-fluid",
-                                        )
+                                html.Div(
+                                    [
+                                        html.A(
+                                            children=[
+                                                html.Img(
+                                                    id="test_image",
+                                                    className="img-fluid",
+                                                )
+                                            ],
+                                            id="test_image_link",
+                                        ),
+                                        html.Canvas(
+                                            id="test_image_overlay",
+                                            style={"display": "none"},
+                                        ),
                                     ],
-                                    id="test_image_link",
+                                    style={"position": "relative"},
                                 )
                             ),
                         ],
@@ -113,6 +162,7 @@ def build_layout(params):
 layout = html.Div(
     [
         dcc.Location(id="url", refresh=False),
+        dcc.Store(id="keypoint-data"),
         dbc.NavbarSimple(
             children=[
                 dbc.NavItem(html.A("About", href="/about", className="nav-link")),
@@ -142,14 +192,23 @@ layout = html.Div(
                                     dbc.CardHeader("Best Frame Match"),
                                     dbc.CardBody([
                                         dcc.Loading(
-                                            html.A(
-                                                children=[
-                                                    html.Img(
-                                                        id="source_image",
-                                                        className="img-fluid",
-                                                    )
+                                            html.Div(
+                                                [
+                                                    html.A(
+                                                        children=[
+                                                            html.Img(
+                                                                id="source_image",
+                                                                className="img-fluid",
+                                                            )
+                                                        ],
+                                                        id="source_image_link",
+                                                    ),
+                                                    html.Canvas(
+                                                        id="source_image_overlay",
+                                                        style={"display": "none"},
+                                                    ),
                                                 ],
-                                                id="source_image_link",
+                                                style={"position": "relative"},
                                             )
                                         ),
                                     ])
@@ -194,41 +253,38 @@ def page_load(href):
     return build_layout(state)
 
 
-@callback(
+clientside_callback(
+    ClientsideFunction(namespace="controls", function_name="url_state"),
     Output("url", "search"),
     inputs=graph_inputs,
 )
-# Add dash kward arg here
-@dash_kwarg(graph_inputs)
-def update_url_state(**kwargs):
-    state = urlencode(kwargs)
-    return f"?{state}"
 
 
-@callback(
+# Hint counts are shipped once per page load in the hint-counts store
+clientside_callback(
+    ClientsideFunction(namespace="controls", function_name="hint_slider"),
     Output("hint-num", "disabled"),
     Output("hint-num", "max"),
     Output("hint-num", "value"),
     Input("frame", "value"),
+    Input("hint-counts", "data"),
 )
-def update_image_src(value):
-    images = glob_re(f"frame{value}-\d+.\w+", os.listdir(f".{src_image_route}"))
-    return False if len(images) > 1 else True, len(images), 1
 
 
 @callback(
-    Output("test_image", "src"),
+    Output("test_image_link", "children"),
     Output("test_image_link", "href"),
-    Output("source_image", "src"),
+    Output("source_image_link", "children"),
     Output("source_image_link", "href"),
     Output("match-list", "children"),
+    Output("keypoint-data", "data"),
     [
         Input("frame", "value"),
         Input("hint-num", "value"),
-        Input("keypoints", "value"),
     ],
+    State("source_image_link", "href"),
 )
-def update_results(frame_no, hint_no, keypoint):
+def update_results(frame_no, hint_no, source_href):
     changed_ids = [p["prop_id"] for p in callback_context.triggered]
     if changed_ids == ["."]:
         raise PreventUpdate
@@ -237,37 +293,45 @@ def update_results(frame_no, hint_no, keypoint):
     test_path = f"frame{frame_no}-{hint_no}.jpg"
 
     try:
-        test_hashes = hash_dict[test_path]
-
-        hash_overlaps = []
+        with timed("frame_game_stage_seconds", stage="match"):
+            matches = match_image(test_path)
 
-        for image_name in list_of_images:
-            hash_overlaps.append(
-                len(set.intersection(set(test_hashes), set(hash_dict[image_name])))
-            )
-
-        if max(hash_overlaps) == 0:
+        if len(matches) == 0:
             raise Exception
 
-        # match_idx = argmax(hash_overlaps)
-        sorted_idx = np.argsort(hash_overlaps)
-        match_idx = sorted_idx[-1]
-        best_frame_no = match_idx + 1
-
     except:
-        test_hashes = None
-        hash_overlaps = [0 for i in range(len(list_of_images))]
+        matches = None
 
-    test_image_path = f"{kps_image_route if keypoint else src_image_route}frame{frame_no}-{hint_no}{'-kps' if keypoint else ''}.jpg"
+    with timed("frame_game_stage_seconds", stage="layout"):
+        return results_layout(frame_no, hint_no, matches, source_href)
 
-    if test_hashes:
-        source_image_path = f"{kps_image_route if keypoint else src_image_route}frame{frame_no}-full{'-kps' if keypoint else ''}.jpg"
+
+def results_layout(frame_no, hint_no, matches, source_href=None):
+    test_image_path = f"{src_image_route}frame{frame_no}-{hint_no}.jpg"
+    keypoint_data = {
+        "test_image": keypoint_sidecar(f"{kps_route}frame{frame_no}-{hint_no}.bin"),
+        "source_image": None,
+    }
+
+    if matches:
+        frame_names = get_hash_store().frame_names
+        frame_entry = get_catalog().get(frame_no, {})
+        source_image_path = frame_entry.get("full") or "/assets/sad_mac.jpg"
+        if frame_entry.get("kps"):
+            keypoint_data["source_image"] = keypoint_sidecar(frame_entry["kps"])
         match_list_children = [
             html.Ol(
                 [
-                    html.Li(f"Frame {idx+1} - {hash_overlaps[idx]} hits")
-                    for idx in sorted_idx[::-1][:10]
-                    if hash_overlaps[idx] > 0
+                    html.Li(
+                        f"Frame {frame_number(frame_names[match.frame])} - "
+                        f"score {match.score:.0f}"
+                        + (
+                            f", {match.confidence:.0%} confidence"
+                            if match.confidence is not None
+                            else ""
+                        )
+                    )
+                    for match in matches
                 ]
             )
         ]
@@ -275,10 +339,31 @@ def update_results(frame_no, hint_no, keypoint):
         source_image_path = f"/assets/sad_mac.jpg"
         match_list_children = ["No matches"]
 
+    # Stepping through a frame's hints mostly keeps the same best frame, which the
+    # browser already shows
+    if asset_url(source_image_path) == source_href:
+        source_image, source_href = no_update, no_update
+    else:
+        source_image = responsive_image(
+            source_image_path, "(min-width: 992px) 50vw, 100vw"
+        )
+        source_href = asset_url(source_image_path)
+
     return (
-        test_image_path,
-        test_image_path,
-        source_image_path,
-        source_image_path,
+        responsive_image(test_image_path, "(min-width: 992px) 25vw, 100vw"),
+        asset_url(test_image_path),
+        source_image,
+        source_href,
         match_list_children,
+        keypoint_data,
     )
+
+
+# Keypoints are drawn over the images in the browser, see assets/keypoints.js
+clientside_callback(
+    ClientsideFunction(namespace="keypoints", function_name="draw"),
+    Output("test_image_overlay", "style"),
+    Output("source_image_overlay", "style"),
+    Input("keypoints", "value"),
+    Input("keypoint-data", "data"),
+)
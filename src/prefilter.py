@@ -0,0 +1,48 @@
+import numpy as np
+from PIL import Image
+
+# Hue, saturation and value bins of the colour signature, one bit per bin
+HSV_BINS = (8, 4, 4)
+# Share of the image a bin must cover for its colour to count as present
+MIN_SHARE = 0.002
+SIGNATURE_SIZE = 64
+
+# Set bits in each possible byte
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(1)
+
+
+def colour_signature(im):
+    # Which coarse HSV colours an image contains, packed into bytes. A hint is a
+    # crop of its frame, so its colours are mostly a subset of the frame's, where
+    # layout based hashes such as pHash or dHash change with the crop
+    im = im.convert("RGB").resize((SIGNATURE_SIZE, SIGNATURE_SIZE)).convert("HSV")
+    hsv = np.asarray(im).astype(np.int64)
+
+    h, s, v = (hsv[..., i] * bins // 256 for i, bins in enumerate(HSV_BINS))
+    bins = (h * HSV_BINS[1] + s) * HSV_BINS[2] + v
+    share = np.bincount(bins.ravel(), minlength=np.prod(HSV_BINS)) / bins.size
+    return np.packbits(share > MIN_SHARE)
+
+
+def read_colour_signature(fp):
+    with Image.open(fp) as im:
+        im.draft("RGB", (SIGNATURE_SIZE * 4, SIGNATURE_SIZE * 4))
+        return colour_signature(im)
+
+
+def containment(signature, frame_signatures):
+    # Share of the query's colours present in each frame
+    shared = POPCOUNT[frame_signatures & signature].sum(axis=1)
+    return shared / max(POPCOUNT[signature].sum(), 1)
+
+
+def prefilter_frames(signature, frame_signatures, keep):
+    # Mask of the frames sharing the most of the query's colours, keep being the
+    # fraction of frames to survive, along with any tied with the last of them
+    scores = containment(signature, frame_signatures)
+    if not len(scores):
+        return scores > 0
+
+    n = min(max(int(np.ceil(keep * len(scores))), 1), len(scores))
+    nth = -np.partition(-scores, n - 1)[n - 1]
+    return scores >= nth
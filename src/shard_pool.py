@@ -0,0 +1,56 @@
+import multiprocessing
+import os
+import threading
+
+from hash_index import merge_top_frames, open_index_shard, score_frames, top_frames
+
+# Shards opened by this pool process, each kept memory-mapped for later queries
+# along with the modification time of its meta.json, as in matching.load_store
+_shards = {}
+
+
+def score_shard(shard_path, hashes, n):
+    mtime = os.stat(f"{shard_path}/meta.json").st_mtime_ns
+    if shard_path not in _shards or _shards[shard_path][0] != mtime:
+        _shards[shard_path] = mtime, open_index_shard(shard_path)
+
+    first_frame, n_frames, index = _shards[shard_path][1]
+    return top_frames(score_frames(index, hashes, n_frames), n, first_frame)
+
+
+class ShardPool:
+    # Scores every shard of a hash store in parallel processes and merges their
+    # top frames into the whole index's
+    def __init__(self, path, n_shards, processes=None):
+        self.shard_paths = [f"{path}/shards/{i}" for i in range(n_shards)]
+        self.processes = processes or n_shards
+
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        # Started on first use by each process that queries, as a pool does not
+        # survive a fork, such as gunicorn's after preloading the app. Pool
+        # processes come from a forkserver, since forking a threaded worker
+        # could copy a lock another thread holds
+        with self._lock:
+            if self._pid != os.getpid():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(["shard_pool"])
+                self._pool = context.Pool(self.processes)
+                self._pid = os.getpid()
+
+        return self._pool
+
+    def top_frames(self, hashes, n):
+        results = self.pool.starmap(
+            score_shard, [(shard_path, hashes, n) for shard_path in self.shard_paths]
+        )
+        return merge_top_frames(results, n)
+
+    def close(self):
+        if self._pid == os.getpid():
+            self._pool.terminate()
+            self._pid = None
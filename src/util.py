@@ -2,15 +2,22 @@ import os
 import re
 
 original_image_path = "./imgs"
+hash_store_path = "./kp_data"
+descriptor_store_path = "./desc_data"
+catalog_path = "./catalog.json"
+asset_manifest_path = "./asset_manifest.json"
 
 src_image_route = "/assets/imgs/"
-kps_image_route = "/assets/imgs_kps/"
+kps_route = "/assets/kps/"
 
 
 def glob_re(pattern, strings):
     return list(filter(re.compile(pattern).match, strings))
 
 
+def frame_number(image_name):
+    return int(image_name.split("-")[0].split("frame")[1])
+
+
 def sort_images(list_of_images):
-    sort_order = lambda x: int(x.split("-")[0].split("frame")[1])
-    return list(sorted(list_of_images, key=sort_order))
+    return list(sorted(list_of_images, key=frame_number))
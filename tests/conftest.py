@@ -0,0 +1,8 @@
+import os
+import sys
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "src")
+
+# The app's modules import each other from src, and read their data relative to it
+sys.path.insert(0, SRC_PATH)
+os.chdir(SRC_PATH)
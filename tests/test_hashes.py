@@ -0,0 +1,97 @@
+import os
+
+import cv2 as cv
+import numpy as np
+import pytest
+from sklearn.neighbors import NearestNeighbors
+
+from hash_index import pack_hashes
+from hashing import HASH_PARAMS, MAX_IMG_HEIGHT, MAX_IMG_WIDTH, get_hashes, load_gray
+from util import original_image_path, sort_images
+
+# Sizes and distances in pixels, as the hashes were before being made scale invariant
+PIXEL_PARAMS = dict(HASH_PARAMS, scale_invariant=False, size_quant_f=1)
+
+# Every sixth bundled image, hints and frames alike
+IMAGE_FILENAMES = sort_images(os.listdir(original_image_path))[::6]
+
+
+def angle(p1, p2):
+    if np.allclose(p1, p2):
+        return 0
+
+    x2 = p2 - p1
+    return np.arccos(np.dot(np.array([0, 1]), x2 / np.linalg.norm(x2)))
+
+
+def reference_hashes(kps, params):
+    # One keypoint pair at a time, as get_hashes did before it was vectorized
+    n_neighbors = params["n_neighbors"]
+    if len(kps) < 1 + n_neighbors:
+        return np.array([], dtype=np.uint64)
+
+    kp_array = np.array([kp.pt for kp in kps])
+    neigh = NearestNeighbors(n_neighbors=1 + n_neighbors)
+    neigh.fit(kp_array)
+    _, knn_inds = neigh.kneighbors(kp_array)
+
+    fields = []
+    for i, kp1 in enumerate(kps):
+        for j in knn_inds[i]:
+            if i == j:
+                continue
+
+            kp2 = kps[j]
+            p1, p2 = np.array(kp1.pt), np.array(kp2.pt)
+            fields.append(
+                (
+                    kp1.angle / params["deg_quant_f"],
+                    kp2.angle / params["deg_quant_f"],
+                    kp1.size / params["size_quant_f"],
+                    kp2.size / params["size_quant_f"],
+                    np.rad2deg(angle(p1, p2)) / params["deg_quant_f"],
+                    np.linalg.norm(p1 - p2) / params["dist_quant_f"],
+                )
+            )
+
+    return pack_hashes(fields)
+
+
+@pytest.fixture(scope="module")
+def sift():
+    return cv.SIFT_create()
+
+
+@pytest.mark.parametrize("image_filename", IMAGE_FILENAMES)
+def test_hashes_match_reference(sift, image_filename):
+    gray, _ = load_gray(
+        f"{original_image_path}/{image_filename}", (MAX_IMG_WIDTH, MAX_IMG_HEIGHT)
+    )
+    kps = sift.detect(gray, None)
+    assert len(kps) > PIXEL_PARAMS["n_neighbors"]
+
+    np.testing.assert_array_equal(
+        get_hashes(kps, PIXEL_PARAMS), reference_hashes(kps, PIXEL_PARAMS)
+    )
+
+
+@pytest.mark.parametrize("n_kps", [0, 1, PIXEL_PARAMS["n_neighbors"]])
+def test_too_few_keypoints(n_kps):
+    kps = [cv.KeyPoint(10.0 * i, 5.0 * i, 4.0, 30.0 * i) for i in range(n_kps)]
+
+    hashes = get_hashes(kps, PIXEL_PARAMS)
+    assert hashes.dtype == np.uint64
+    assert len(hashes) == 0
+
+
+def test_duplicate_keypoints():
+    # SIFT reports a point once per orientation, so pairs can share a position
+    kps = [
+        cv.KeyPoint(x, y, size, angle)
+        for x, y in [(0.0, 0.0), (12.5, 3.0), (40.0, 40.0), (7.0, 90.0)]
+        for size, angle in [(3.0, 10.0), (3.0, 200.0), (5.5, 10.0)]
+    ]
+
+    hashes = get_hashes(kps, PIXEL_PARAMS)
+    assert len(hashes)
+    np.testing.assert_array_equal(hashes, reference_hashes(kps, PIXEL_PARAMS))
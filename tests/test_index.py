@@ -0,0 +1,45 @@
+import numpy as np
+
+from hash_index import build_inverted_index, score_frames, top_frames
+
+
+def corpus(n_frames, rng):
+    # Frames drawn from a shared pool of hashes, so many are in several frames
+    frame_names = [f"frame{i}-full.jpg" for i in range(n_frames)]
+    hash_dict = {
+        name: np.unique(rng.integers(0, 2000, 200).astype(np.uint64))
+        for name in frame_names
+    }
+    return hash_dict, frame_names
+
+
+def test_small_corpus_keeps_shared_hashes():
+    # Under 50 frames, 2% of the frames is less than one
+    rng = np.random.default_rng(0)
+    hash_dict, frame_names = corpus(30, rng)
+    index = build_inverted_index(hash_dict, frame_names, 0.02)
+    assert len(index.keys)
+
+    # A hint holds part of its frame's hashes
+    for frame, name in enumerate(frame_names):
+        hint = rng.choice(hash_dict[name], 40, replace=False)
+        frames, _ = top_frames(score_frames(index, hint, len(frame_names)), 1)
+        assert list(frames) == [frame]
+
+
+def test_idf_weights_differ():
+    hash_dict, frame_names = corpus(72, np.random.default_rng(1))
+    index = build_inverted_index(hash_dict, frame_names, 0.1)
+
+    assert len(np.unique(index.weights)) > 1
+    # Rarer hashes weigh more
+    counts = np.diff(index.offsets)
+    assert index.weights[counts.argmin()] > index.weights[counts.argmax()]
+
+
+def test_stop_hashes_dropped():
+    hash_dict, frame_names = corpus(72, np.random.default_rng(2))
+    index = build_inverted_index(hash_dict, frame_names, 0.1)
+
+    assert np.diff(index.offsets).max() <= 0.1 * len(frame_names)
+    assert len(index.keys) < len(build_inverted_index(hash_dict, frame_names).keys)
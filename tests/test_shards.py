@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from hash_index import (
+    build_inverted_index,
+    score_frames,
+    top_frames,
+    write_index_shards,
+)
+from shard_pool import ShardPool
+
+N_FRAMES = 12
+
+
+@pytest.fixture(scope="module")
+def index():
+    # Few distinct hashes so frames share many, and the last frames repeating
+    # earlier ones' hashes exactly, so scores tie across shard boundaries
+    rng = np.random.default_rng(0)
+    hashes = [np.unique(rng.integers(0, 40, 15).astype(np.uint64)) for _ in range(8)]
+    hashes += hashes[3:7]
+
+    frame_names = [f"frame{i}" for i in range(N_FRAMES)]
+    return build_inverted_index(dict(zip(frame_names, hashes)), frame_names)
+
+
+@pytest.fixture(scope="module")
+def queries():
+    rng = np.random.default_rng(1)
+    return [
+        np.unique(rng.integers(0, 48, size).astype(np.uint64)) for size in (1, 5, 20)
+    ]
+
+
+@pytest.mark.parametrize("n_shards", [1, 3, 5, N_FRAMES, N_FRAMES + 4])
+def test_pool_matches_single_index(tmp_path, index, queries, n_shards):
+    write_index_shards(str(tmp_path), index, N_FRAMES, n_shards)
+    pool = ShardPool(str(tmp_path), n_shards, processes=2)
+    try:
+        for hashes in queries:
+            scores = score_frames(index, hashes, N_FRAMES)
+            for n in (1, 4, N_FRAMES + 1):
+                expected_frames, expected_scores = top_frames(scores, n)
+                frames, shard_scores = pool.top_frames(hashes, n)
+
+                np.testing.assert_array_equal(frames, expected_frames)
+                np.testing.assert_allclose(shard_scores, expected_scores, rtol=1e-6)
+    finally:
+        pool.close()
+
+
+def test_queries_tie(index, queries):
+    # The comparison above is only meaningful if some top frames tie
+    scores = score_frames(index, queries[-1], N_FRAMES)
+    assert len(np.unique(scores[scores > 0])) < np.count_nonzero(scores)